@@ -41,7 +41,45 @@ const defaultConfig = {
 	},
 	Telegram: {
 		CHECK_HISTORY_OFFSET: 43200000,
-		LOG_LEVEL: 10
+		LOG_LEVEL: 10,
+		MAX_CONCURRENT_ORIGINS: 4,
+		FLOOD_WAIT_RETRIES: 3,
+		DEDUPE_WINDOW: 100,
+		BULK_INSERT: true,
+		INSERT_FLUSH_SECONDS: 30,
+		ANALYSIS_WORKERS: 2,
+		ANALYSIS_MAX_ATTEMPTS: 3,
+		ANALYSIS_RETRY_SECONDS: 60,
+		MAX_CONCURRENT_DOWNLOADS: 3,
+		DOWNLOAD_CHUNK_SIZE: 524288,
+		DOWNLOAD_RETRIES: 3,
+		MAX_DOWNLOAD_BYTES_PER_SECOND: 0,
+		FILTERED_SCAN: true,
+		FILTERED_SCAN_SEARCH: false,
+		DAEMON_SWEEP_SECONDS: 3600,
+		CHECKPOINT_MESSAGES: 1000,
+		CHECKPOINT_SECONDS: 60,
+		ENTITY_CACHE_TTL: 604800,
+		HISTORY_TRACKED_FIELDS: ['about', 'participants_count', 'admins_count', 'hidden_prehistory'],
+		ACCOUNTS: [],
+		METRICS: false,
+		METRICS_TEXTFILE: '',
+		IMPORT_CONCURRENCY: 4,
+		IMPORT_REQUESTS_PER_SECOND: 1,
+		IMPORT_BATCH_SIZE: 50,
+		SCHEDULER: true,
+		SCHEDULE_MIN_INTERVAL: 900,
+		SCHEDULE_MAX_INTERVAL: 604800,
+		SCHEDULE_ACTIVITY_DECAY: 0.7,
+		PRESCREEN: true,
+		PRESCREEN_BYTES: 4096,
+		PRESCREEN_MIN_SIZE: 256,
+		PRESCREEN_MAX_SIZE: 0,
+		PRESCREEN_ARCHIVES: false,
+		BACKFILL: true,
+		BACKFILL_SEGMENT_MESSAGES: 20000,
+		BACKFILL_CONCURRENCY: 4,
+		BACKFILL_MAX_SECONDS: 1800
 	},
 };
 
@@ -9,9 +9,15 @@ console.log("Passo la prima mano")
 	await resetTable("data")
 	await resetTable("database_metadata")
 	await resetTable("source_thread")
+	await resetTable("analysis_queue")
+	await resetTable("source_content")
+	await resetTable("content_index")
 	await resetTable("source_telegram")
 	await resetTable("source")
 	await resetTable("origin_history")
+	await resetTable("origin_entity")
+	await resetTable("origin_schedule")
+	await resetTable("backfill_segment")
 	await resetTable("author")
 	await resetTable("database_metadata")
 	await resetTable("origin")
@@ -22,9 +28,15 @@ console.log("Passo la prima mano")
 	await resetTable("data")
 	await resetTable("database_metadata")
 	await resetTable("source_thread")
+	await resetTable("analysis_queue")
+	await resetTable("source_content")
+	await resetTable("content_index")
 	await resetTable("source_telegram")
 	await resetTable("source")
 	await resetTable("origin_history")
+	await resetTable("origin_entity")
+	await resetTable("origin_schedule")
+	await resetTable("backfill_segment")
 	await resetTable("author")
 	await resetTable("database_metadata")
 	await resetTable("origin")
@@ -1,3 +1,5 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm; -- Substring search on the messages
+
 CREATE TABLE IF NOT EXISTS origin(
 	_id_origin serial PRIMARY KEY,
 	domain varchar(255) NOT NULL,
@@ -54,6 +56,7 @@ CREATE TABLE IF NOT EXISTS source_thread(
 CREATE TABLE IF NOT EXISTS source_telegram(
 	_id_source_telegram int, -- This i the local ID of the messages. A serial ID growing in every channel
 	message_text varchar(4096) NOT NULL,
+	message_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', message_text)) STORED, -- Keyword search, 'simple' since the channels write in every language
     views_count int,
 	shares_count int,
 	_id_source int,	-- FIXME per come è fatto potrebbe anche essere chiave unica, ma non trovo grandi fonti. Andrebbe revisionato con uno che ne sa ahah
@@ -115,6 +118,7 @@ CREATE TABLE IF NOT EXISTS data(
 CREATE TABLE IF NOT EXISTS origin_history(
 	_id_origin_history serial PRIMARY KEY,
 	additional_infos varchar(16383),
+	parsed_infos jsonb, -- Telegram origins, compact snapshot from sentinel.parse_channel_info
 	updated_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
 	_id_origin int NOT NULL,
 	CONSTRAINT _fk_origin
@@ -122,4 +126,100 @@ CREATE TABLE IF NOT EXISTS origin_history(
 			REFERENCES origin(_id_origin)
 			ON DELETE RESTRICT
 			ON UPDATE CASCADE
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS analysis_queue(
+	_id_analysis_queue serial PRIMARY KEY,
+	file_path varchar(1024) NOT NULL,
+	status int NOT NULL DEFAULT 0, -- 0 pending, 1 running, 2 done, 3 failed
+	attempts int NOT NULL DEFAULT 0,
+	enqueued_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	updated_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	_id_source int NOT NULL,
+	CONSTRAINT _fk_source
+		FOREIGN KEY(_id_source)
+			REFERENCES source(_id_source)
+			ON DELETE RESTRICT
+			ON UPDATE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS content_index(
+	_id_content serial PRIMARY KEY,
+	sha256 char(64) NOT NULL UNIQUE,
+	size bigint NOT NULL,
+	file_path varchar(1024) NOT NULL, -- Content addressed, supported_files/<sha256[:2]>/<sha256>.<ext>
+	first_seen_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS source_content(
+	_id_source int PRIMARY KEY,
+	document_id bigint, -- Telegram document id, the same repost keeps the same id across channels
+	size bigint,
+	_id_content int NOT NULL,
+	CONSTRAINT _fk_source
+		FOREIGN KEY(_id_source)
+			REFERENCES source(_id_source)
+			ON DELETE RESTRICT
+			ON UPDATE CASCADE,
+	CONSTRAINT _fk_content_index
+		FOREIGN KEY(_id_content)
+			REFERENCES content_index(_id_content)
+			ON DELETE RESTRICT
+			ON UPDATE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS source_content_document_idx ON source_content(document_id, size);
+
+CREATE TABLE IF NOT EXISTS origin_entity(
+	_id_origin int NOT NULL,
+	account varchar(32) NOT NULL DEFAULT '', -- access_hash is different for every telegram account
+	channel_id bigint NOT NULL,
+	access_hash bigint NOT NULL,
+	resolved_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	metadata jsonb, -- parse_channel_info of the last GetFullChannelRequest
+	PRIMARY KEY (_id_origin, account),
+	CONSTRAINT _fk_origin
+		FOREIGN KEY(_id_origin)
+			REFERENCES origin(_id_origin)
+			ON DELETE CASCADE
+			ON UPDATE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS origin_schedule(
+	_id_origin int PRIMARY KEY,
+	next_due timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	interval_seconds int NOT NULL, -- Shrinks while the channel posts new files, grows while it is quiet or dead
+	activity real NOT NULL DEFAULT 0, -- Moving average of the new files per check
+	new_messages int NOT NULL DEFAULT 0, -- Of the last check
+	new_files int NOT NULL DEFAULT 0,
+	checked_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	CONSTRAINT _fk_origin
+		FOREIGN KEY(_id_origin)
+			REFERENCES origin(_id_origin)
+			ON DELETE CASCADE
+			ON UPDATE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS backfill_segment(
+	_id_origin int,
+	min_id int, -- Segment of the first check of a big channel, message ids in (min_id, max_id]
+	max_id int NOT NULL,
+	last_checked int NOT NULL, -- Progress inside the segment, done at max_id
+	updated_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	CONSTRAINT _fk_origin
+		FOREIGN KEY(_id_origin)
+			REFERENCES origin(_id_origin)
+			ON DELETE CASCADE
+			ON UPDATE CASCADE,
+	PRIMARY KEY (_id_origin, min_id)
+);
+
+CREATE INDEX IF NOT EXISTS origin_category_domain_idx ON origin(category, domain);
+CREATE INDEX IF NOT EXISTS origin_history_origin_time_idx ON origin_history(_id_origin, updated_time DESC);
+CREATE INDEX IF NOT EXISTS source_origin_idx ON source(_id_origin);
+CREATE INDEX IF NOT EXISTS source_telegram_source_idx ON source_telegram(_id_source, _id_source_telegram);
+CREATE INDEX IF NOT EXISTS analysis_queue_source_idx ON analysis_queue(_id_source);
+CREATE INDEX IF NOT EXISTS analysis_queue_pending_idx ON analysis_queue(_id_analysis_queue) WHERE status IN (0, 1);
+CREATE INDEX IF NOT EXISTS origin_schedule_due_idx ON origin_schedule(next_due);
+CREATE INDEX IF NOT EXISTS source_telegram_tsv_idx ON source_telegram USING gin(message_tsv);
+CREATE INDEX IF NOT EXISTS source_telegram_trgm_idx ON source_telegram USING gin(message_text gin_trgm_ops);
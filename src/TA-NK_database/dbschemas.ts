@@ -162,18 +162,20 @@ const origin = {
 export interface OriginHistory {
   _id_origin_history: number;
   additional_infos: string | null;
+  parsed_infos: Json | null;
   updated_time: Date | number | null;
   _id_origin: number;
 }
 export interface OriginHistoryInput {
   _id_origin_history?: number;
   additional_infos?: string | null;
+  parsed_infos?: Json | null;
   updated_time?: Date | number | null;
   _id_origin: number;
 }
 const origin_history = {
   tableName: 'origin_history',
-  columns: ['_id_origin_history', 'additional_infos', 'updated_time', '_id_origin'],
+  columns: ['_id_origin_history', 'additional_infos', 'parsed_infos', 'updated_time', '_id_origin'],
   requiredForInsert: ['_id_origin'],
   primaryKey: '_id_origin_history',
   foreignKeys: { _id_origin: { table: 'origin', column: '_id_origin', $type: null as unknown as Origin }, },
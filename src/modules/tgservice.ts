@@ -0,0 +1,125 @@
+/**
+ * @module tgservice
+ * @description Client of the long lived telegram service (src/telegram/service.py), JSON-RPC 2.0 over the stdio of the python process
+ * @category misc
+ */
+
+import { ChildProcessWithoutNullStreams, spawn } from 'child_process'
+import readline from 'readline'
+import path from 'path'
+import { style } from './style.js'
+
+type Pending = { resolve: (result: any) => void, reject: (error: Error) => void }
+
+/**
+ * Keeps a single python process with the telegram clients and the db pool warm between the commands of walle.
+ * The process is started at the first request, the telegram sessions must be already logged in.
+ * When it can't start, the following requests are rejected with the same error until reset().
+ */
+export class TelegramService {
+	private py: ChildProcessWithoutNullStreams | null = null
+	private ready: Promise<void> | null = null
+	private next_id = 1
+	private pending = new Map<number, Pending>()
+
+	constructor(private root_path: string) {}
+
+	/**
+	 * Starts the service if needed
+	 *
+	 * @returns {Promise<void>} Resolved once the clients and the pool are up, rejected when the service can't start (e.g. the session was never logged in)
+	 */
+	start(): Promise<void> {
+		if (this.ready) {
+			return this.ready
+		}
+
+		let started = false
+		this.ready = new Promise((resolve, reject) => {
+			const py = spawn("python", ["service.py"], { cwd: path.join(this.root_path, "/src/telegram/") })
+			this.py = py
+
+			readline.createInterface({ input: py.stdout }).on('line', (line) => {
+				let message
+				try {
+					message = JSON.parse(line)
+				} catch (err) {
+					return
+				}
+
+				if (message.id !== undefined && message.id !== null) {
+					const pending = this.pending.get(message.id)
+					this.pending.delete(message.id)
+					if (message.error) {
+						pending?.reject(new Error(message.error.message))
+					} else {
+						pending?.resolve(message.result)
+					}
+				} else if (message.method === 'ready') {
+					started = true
+					resolve()
+				} else if (message.method === 'failed') {
+					reject(new Error(message.params.message))
+				} else if (message.method === 'scrape_done') {
+					console.log(style.success(`Telegram scrape done in ${message.params.seconds} seconds: ${message.params.scraped} origins scraped, ${message.params.failed} failed`))
+				}
+			})
+
+			py.stderr.on('data', (data) => {
+				console.log(data.toString())
+			})
+
+			py.on('exit', () => {
+				// Whatever was waiting will never get an answer, the next request starts a new process
+				reject(new Error('Telegram service stopped'))
+				this.pending.forEach((pending) => pending.reject(new Error('Telegram service stopped')))
+				this.pending.clear()
+				this.py = null
+				// A service that never started would fail the same way at every request, that failure is kept until reset()
+				if (started) {
+					this.ready = null
+				}
+			})
+			py.on('error', reject)
+		})
+		return this.ready
+	}
+
+	/**
+	 * Forgets a failed start, the next request starts the service again. For when something changed, e.g. a script run logged the session in
+	 */
+	reset() {
+		if (!this.py) {
+			this.ready = null
+		}
+	}
+
+	/**
+	 * Sends a command to the service: add_origin, scrape_now, status, list_origins, shutdown
+	 *
+	 * @param {string} method Name of the command
+	 * @param {Object} [params={}] Named parameters of the command
+	 * @returns {Promise<any>} Result of the command, rejected with the error message of the service
+	 */
+	async request(method: string, params: object = {}): Promise<any> {
+		await this.start()
+
+		const id = this.next_id++
+		return new Promise((resolve, reject) => {
+			this.pending.set(id, { resolve, reject })
+			this.py?.stdin.write(JSON.stringify({ jsonrpc: '2.0', id: id, method: method, params: params }) + '\n')
+		})
+	}
+
+	/**
+	 * Stops the service, the running downloads and analysis are completed first
+	 */
+	async stop() {
+		if (this.py) {
+			const py = this.py
+			const exited = new Promise((resolve) => py.on('exit', resolve))
+			py.stdin.end() // stdin closed, same as the shutdown command
+			await exited
+		}
+	}
+}
@@ -0,0 +1,74 @@
+import hashlib, logging
+
+from telethon.errors import UserDeactivatedError, UserDeactivatedBanError, AuthKeyUnregisteredError, PhoneNumberBannedError, SessionRevokedError
+
+logging = logging.getLogger(__name__)
+
+# The account can't be used anymore for this run
+BAN_ERRORS = (UserDeactivatedError, UserDeactivatedBanError, AuthKeyUnregisteredError, PhoneNumberBannedError, SessionRevokedError)
+
+
+# A telegram account of the pool, with its own client, flood budget and transfers
+class Account:
+
+	def __init__(self, name, client, floodgate, download_manager):
+		self.name = name
+		self.client = client
+		self.floodgate = floodgate
+		self.download_manager = download_manager
+		self.banned = False
+		self.origins = 0 # Origins scraped successfully
+		self.failures = 0
+		self.flood_waits = 0
+
+	def is_available(self):
+		return not self.banned and self.floodgate.is_open()
+
+	def flood_wait(self, seconds):
+		self.flood_waits += 1
+		self.floodgate.trip(seconds)
+
+	def stats(self):
+		return {
+			'account': self.name,
+			'banned': self.banned,
+			'origins': self.origins,
+			'failures': self.failures,
+			'flood_waits': self.flood_waits,
+			'flood_wait_seconds': self.floodgate.total_wait_seconds
+		}
+
+
+# Origins are spread on the accounts by rendezvous hashing: every origin has its own stable order of
+# preference over the accounts, so it always lands on the same one (and on the same cached entity)
+# and adding or removing an account moves only the origins of that account. When the preferred
+# account is flood-waited or banned the origin fails over to the next one of its order.
+class AccountPool:
+
+	def __init__(self, accounts):
+		self.accounts = accounts
+
+	def preference(self, _id_origin):
+		return sorted(self.accounts, key=lambda account: hashlib.sha1(f'{_id_origin}:{account.name}'.encode()).digest(), reverse=True)
+
+	def for_origin(self, _id_origin):
+		candidates = [account for account in self.preference(_id_origin) if not account.banned]
+		if not candidates:
+			return None
+
+		for account in candidates:
+			if account.is_available():
+				return account
+		return candidates[0] # Everyone is waiting, the caller waits on its preferred one
+
+	def ban(self, account, error):
+		if not account.banned:
+			logging.critical('Account %s can not be used anymore, its origins move to the other accounts: %s', account.name, error)
+		account.banned = True
+
+	def available(self):
+		return [account for account in self.accounts if not account.banned]
+
+	def log_stats(self):
+		for account in self.accounts:
+			logging.info('Account %(account)s: %(origins)s origins, %(failures)s failures, %(flood_waits)s FloodWaits for %(flood_wait_seconds)s seconds, banned: %(banned)s', account.stats())
@@ -0,0 +1,110 @@
+import asyncio, logging
+
+from db import insertAnalysisJob, selectPendingAnalysisJobs, updateAnalysisJobStatus, selectAnalysisJobCount
+from metrics import timed
+
+logging = logging.getLogger(__name__)
+
+# analysis_queue.status
+PENDING = 0
+RUNNING = 1
+DONE = 2
+FAILED = 3
+
+
+@timed('tgscraper_analysis_seconds')
+async def call_node_script(script_path, args=None):
+	logging.debug('Calling node subprocess %s', script_path)
+	command = ["node", script_path]
+
+	if args:
+		command.extend(args)
+
+	try:
+		process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+		stdout, stderr = await process.communicate()
+		if process.returncode == 0:
+			logging.debug('Subprocess executed successfully')
+			logging.info(stdout.decode(errors='replace'))
+			return True
+		else:
+			logging.error('Subprocess execution failed.\n%s', stderr.decode(errors='replace'))
+			return False
+	except FileNotFoundError:
+		logging.critical("Node.js interpreter not found. Please make sure Node.js is installed.")
+		return False
+
+
+# Downloaded files waiting for halAnalyzeDBs. Every job is saved in the analysis_queue table
+# before running, so whatever is still pending when the scraper dies is picked up by resume()
+# on the next run. At most max_workers node processes run at the same time. A failed job is
+# retried in the same process after retry_delay seconds, doubled at every attempt.
+class AnalysisQueue:
+
+	def __init__(self, pool, script_path, max_workers=2, max_attempts=3, retry_delay=60):
+		self.pool = pool
+		self.script_path = script_path
+		self.max_attempts = max_attempts
+		self.retry_delay = retry_delay
+		self._semaphore = asyncio.Semaphore(max(1, max_workers))
+		self._tasks = set()
+
+	async def resume(self):
+		jobs = await selectPendingAnalysisJobs(self.pool, self.max_attempts)
+		if jobs == None:
+			logging.error('Error while loading the pending analysis jobs')
+			return 0
+
+		resumed = 0
+		for job in jobs:
+			if job['attempts'] >= self.max_attempts:
+				# Died during its last attempt
+				logging.error('Analysis of %s failed %s times, giving up', job['file_path'], job['attempts'])
+				await updateAnalysisJobStatus(self.pool, job['_id_analysis_queue'], FAILED)
+				continue
+			self._schedule(job['_id_analysis_queue'], job['_id_source'], job['file_path'])
+			resumed += 1
+
+		if resumed:
+			logging.info('Resumed %s analysis jobs left from a previous run', resumed)
+		return resumed
+
+	# A stored file without a pending, running or done job was stored by a run that died before queueing it
+	async def is_queued(self, file_path):
+		return await selectAnalysisJobCount(self.pool, file_path) != 0
+
+	def _schedule(self, _id_analysis_queue, _id_source, file_path, delay=0):
+		task = asyncio.create_task(self._run(_id_analysis_queue, _id_source, file_path, delay))
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+
+	async def _run(self, _id_analysis_queue, _id_source, file_path, delay=0):
+		if delay:
+			await asyncio.sleep(delay)
+
+		async with self._semaphore:
+			attempts = await updateAnalysisJobStatus(self.pool, _id_analysis_queue, RUNNING, new_attempt=True)
+
+			done = await call_node_script(self.script_path, args=[("--target_file="+file_path),('--source_id='+str(_id_source))])
+
+			if done:
+				status = DONE
+			elif attempts != None and attempts >= self.max_attempts:
+				logging.error('Analysis of %s failed %s times, giving up', file_path, attempts)
+				status = FAILED
+			else:
+				status = PENDING # The daemon and the service never get a next run, retried here
+
+			await updateAnalysisJobStatus(self.pool, _id_analysis_queue, status)
+
+		if status == PENDING and attempts != None: # No attempt count, the db is in trouble: left to the next run
+			delay = self.retry_delay * 2 ** ((attempts or 1) - 1)
+			logging.warning('Analysis of %s failed (attempt %s/%s), retrying in %s seconds', file_path, attempts, self.max_attempts, delay)
+			self._schedule(_id_analysis_queue, _id_source, file_path, delay)
+
+	def pending(self):
+		return len(self._tasks)
+
+	async def join(self):
+		while self._tasks:
+			await asyncio.gather(*list(self._tasks), return_exceptions=True)
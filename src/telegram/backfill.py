@@ -0,0 +1,27 @@
+import logging
+
+from checkpoint import Checkpoint
+from db import updateBackfillSegment
+
+logging = logging.getLogger(__name__)
+
+
+# The ids of a channel, 1 to head_id, in segments of segment_messages: (min_id, max_id], like offset_id and the head of a scan
+def plan_segments(head_id, segment_messages):
+	segment_messages = max(1, segment_messages)
+	return [(min_id, min(min_id + segment_messages, head_id)) for min_id in range(0, head_id, segment_messages)]
+
+def segment_done(segment):
+	return segment['last_checked'] >= segment['max_id']
+
+
+# Same rules of the origin checkpoint, but the progress goes to the backfill segment:
+# origin.last_checked is set only once every segment is done
+class SegmentCheckpoint(Checkpoint):
+
+	def __init__(self, pool, _id_origin, domain, segment):
+		super().__init__(pool, _id_origin, domain, segment['last_checked'])
+		self.min_id = segment['min_id']
+
+	async def _persist(self, safe_id):
+		return await updateBackfillSegment(self.pool, self._id_origin, self.min_id, safe_id)
@@ -0,0 +1,537 @@
+import argparse, asyncio, json, logging, os, random, resource, subprocess, sys, tempfile, time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytz
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Document, DocumentAttributeFilename, MessageMediaDocument, InputPeerChannel
+
+import tgscraper, analyzer, metrics
+from db import create_async_pool, insertOrigin, insertOriginHistory
+from floodgate import FloodGate
+from analyzer import AnalysisQueue
+from downloader import DownloadManager
+from contentstore import ContentStore
+from prescreen import PreScreen, document_file_name
+
+# Offline benchmark of the scraper: synthetic channels served by an in-process telegram client and
+# an in-memory stand-in of the asyncpg pool (or a real local database with --RealDB, use a scratch one).
+#   python benchmark.py -o 1000 -n 1000                 1k origins, 1M messages through main()
+#   python benchmark.py --Mode scan -o 10 -n 100000     download_supported_files only
+# Append the results to a file with --Output to compare them between releases.
+
+PAGE_SIZE = 100 # Messages per GetHistory request, as telethon does
+
+
+##############################################################
+### Fake telegram ############################################
+
+class FakeChannel:
+
+	def __init__(self, index, messages, document_ratio, file_size, extensions):
+		self.index = index
+		self.username = f'bench_channel_{index}'
+		self.channel_id = 1000000 + index
+		self.access_hash = index * 7919
+		self.messages = messages
+		self.document_ratio = document_ratio
+		self.file_size = file_size
+		self.extensions = extensions
+		self.date = datetime(2023, 1, 1, tzinfo=pytz.UTC)
+
+	# Same message for the same id at every call, without keeping a million of them around
+	def message(self, message_id):
+		media = None
+		roll = (message_id * 2654435761 + self.index * 40503) % 10000
+		if roll < self.document_ratio * 10000:
+			ext = self.extensions[roll % len(self.extensions)]
+			document_id = self.channel_id * 10000000 + message_id
+			media = MessageMediaDocument(document=Document(id=document_id, access_hash=0, file_reference=b'', date=self.date, mime_type='application/octet-stream',
+				size=self.file_size, dc_id=2, attributes=[DocumentAttributeFilename(f'dump_{message_id}.{ext}')]))
+		return SimpleNamespace(id=message_id, date=self.date + timedelta(seconds=message_id), raw_text=f'message {message_id}', views=message_id % 1000, forwards=0, media=media)
+
+
+# Same buffer/index protocol of telethon's RequestIter, so metrics.pages sees the page fetches
+class FakeMessageIter:
+
+	def __init__(self, client, channel, offset_id, max_id, documents_only, search):
+		self.client = client
+		self.channel = channel
+		self.next_id = offset_id + 1
+		self.last_id = min(max_id - 1, channel.messages) if max_id else channel.messages # max_id excluded, as telethon
+		self.documents_only = documents_only
+		self.search = search
+		self.buffer = None
+		self.index = 0
+
+	def __aiter__(self):
+		return self
+
+	def matches(self, message):
+		if not self.documents_only:
+			return True
+		if message.media == None:
+			return False
+		return self.search == None or self.search in document_file_name(message.media.document)
+
+	async def __anext__(self):
+		while self.buffer == None or self.index >= len(self.buffer):
+			if self.next_id > self.last_id:
+				raise StopAsyncIteration
+			await self.client.request()
+			# A filtered page still scans PAGE_SIZE ids server side, but comes back with the documents only
+			last_id = min(self.next_id + PAGE_SIZE - 1, self.last_id)
+			self.buffer = [message for message in map(self.channel.message, range(self.next_id, last_id + 1)) if self.matches(message)]
+			self.index = 0
+			self.next_id = last_id + 1
+
+		message = self.buffer[self.index]
+		self.index += 1
+		return message
+
+
+class FakeClient:
+
+	def __init__(self, channels, latency, flood_wait_ratio, flood_wait_seconds, seed):
+		self.channels = {channel.username: channel for channel in channels}
+		self.channels.update({channel.channel_id: channel for channel in channels})
+		self.latency = latency
+		self.flood_wait_ratio = flood_wait_ratio
+		self.flood_wait_seconds = flood_wait_seconds
+		self.random = random.Random(seed)
+		self.requests = 0
+		self.flood_waits = 0
+
+	async def request(self):
+		self.requests += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		if self.random.random() < self.flood_wait_ratio:
+			self.flood_waits += 1
+			raise FloodWaitError(request=None, capture=self.flood_wait_seconds)
+
+	def channel(self, chat):
+		if isinstance(chat, InputPeerChannel):
+			return self.channels[chat.channel_id]
+		return self.channels[chat]
+
+	async def get_me(self):
+		return SimpleNamespace(username='benchmark')
+
+	async def get_entity(self, chat):
+		await self.request()
+		channel = self.channel(chat)
+		return SimpleNamespace(id=channel.channel_id, access_hash=channel.access_hash, username=channel.username)
+
+	async def get_peer_id(self, chat):
+		return -1000000000000 - self.channel(chat).channel_id
+
+	# GetFullChannelRequest, the only raw request of the scraper
+	async def __call__(self, request):
+		await self.request()
+		channel = self.channels[request.channel.id]
+		return SimpleNamespace(
+			full_chat=SimpleNamespace(id=channel.channel_id, about=f'about {channel.username}', read_inbox_max_id=0, pts=channel.messages,
+				hidden_prehistory=False, participants_count=1000 + channel.index, admins_count=1),
+			chats=[SimpleNamespace(date=channel.date, access_hash=channel.access_hash)])
+
+	async def get_messages(self, chat, limit=1):
+		await self.request()
+		channel = self.channel(chat)
+		return [channel.message(channel.messages)] if channel.messages else []
+
+	def iter_messages(self, chat, reverse=True, offset_id=0, max_id=0, filter=None, search=None):
+		return FakeMessageIter(self, self.channel(chat), offset_id, max_id, filter != None, search)
+
+	async def iter_download(self, document, offset=0, request_size=512*1024, limit=None):
+		# A csv with the document id on every line, or every download would end up with the same hash
+		line = f'{document.id},user@example.com,password\n'.encode()
+		while offset < document.size and limit != 0:
+			await self.request()
+			size = min(request_size, document.size - offset)
+			start = offset % len(line)
+			chunk = (line[start:] + line * (size // len(line) + 1))[:size]
+			offset += size
+			limit = limit - 1 if limit else limit
+			yield chunk
+
+	def add_event_handler(self, callback, event):
+		pass
+
+	async def disconnect(self):
+		pass
+
+
+##############################################################
+### Fake database ############################################
+
+# Counts what goes to Postgres, BEGIN and COMMIT of the transactions included
+class CountingConnection:
+
+	def __init__(self, conn, stats):
+		self._conn = conn
+		self._stats = stats
+
+	def _count(self, method):
+		async def call(*args, **kwargs):
+			self._stats['queries'] += 1
+			self._stats['round_trips'] += 1
+			return await method(*args, **kwargs)
+		return call
+
+	def __getattr__(self, name):
+		attribute = getattr(self._conn, name)
+		if name in ('fetch', 'fetchrow', 'fetchval', 'execute', 'executemany', 'copy_records_to_table'):
+			return self._count(attribute)
+		return attribute
+
+	@asynccontextmanager
+	async def transaction(self):
+		self._stats['round_trips'] += 2
+		async with self._conn.transaction():
+			yield
+
+
+class CountingPool:
+
+	def __init__(self, pool):
+		self._pool = pool
+		self.stats = {'queries': 0, 'round_trips': 0}
+
+	@asynccontextmanager
+	async def acquire(self):
+		async with self._pool.acquire() as conn:
+			yield CountingConnection(conn, self.stats)
+
+	async def close(self):
+		await self._pool.close()
+
+
+# Just enough of the scraper's queries to keep its state consistent, told apart by their text
+class FakeConnection:
+
+	def __init__(self, db):
+		self.db = db
+
+	@asynccontextmanager
+	async def transaction(self):
+		yield
+
+	async def _round_trip(self):
+		if self.db.latency:
+			await asyncio.sleep(self.db.latency)
+
+	async def fetch(self, query, *args):
+		await self._round_trip()
+		return self.db.fetch(query, args)
+
+	async def fetchrow(self, query, *args):
+		await self._round_trip()
+		rows = self.db.fetch(query, args)
+		return rows[0] if rows else None
+
+	async def fetchval(self, query, *args):
+		row = await self.fetchrow(query, *args)
+		return next(iter(row.values())) if row else None
+
+	async def copy_records_to_table(self, table, records, columns):
+		await self._round_trip()
+		self.db.copy(table, records)
+
+
+class FakePool:
+
+	def __init__(self, latency=0):
+		self.latency = latency
+		self.origins = {} # _id_origin -> origin row
+		self.sources = {} # _id_source -> _id_origin
+		self.source_telegram = {} # (_id_origin, _id_source_telegram) -> _id_source
+		self.contents = {} # sha256 -> content row
+		self.source_content = {} # _id_source -> (document_id, size, _id_content)
+		self.analysis_jobs = [] # file paths
+		self.entities = {}
+		self.domains = {} # domain -> _id_origin
+		self.segments = {} # _id_origin -> {min_id: backfill segment row}
+		self.serial = 0
+
+	def next_id(self):
+		self.serial += 1
+		return self.serial
+
+	@asynccontextmanager
+	async def acquire(self):
+		yield FakeConnection(self)
+
+	async def close(self):
+		pass
+
+	def add_origin(self, channel):
+		_id_origin = self.next_id()
+		self.origins[_id_origin] = {
+			'_id_origin': _id_origin, 'domain': channel.username, 'name': None, 'is_dead_score': 0, 'category': 1, 'last_checked': 0,
+			'_id_origin_history': self.next_id(), 'updated_time': datetime.utcnow().replace(tzinfo=pytz.UTC), 'parsed_infos': None
+		}
+		self.domains[channel.username] = _id_origin
+		return _id_origin
+
+	def copy(self, table, records):
+		if table == 'source':
+			for _id_source, _, _, _id_origin, _ in records:
+				self.sources[_id_source] = _id_origin
+		else:
+			for _id_source_telegram, _, _, _, _id_source in records:
+				self.source_telegram[(self.sources[_id_source], _id_source_telegram)] = _id_source
+
+	# Copies of the rows, like the asyncpg Records a later update can't change
+	def fetch(self, query, args):
+		if 'nextval' in query:
+			return [{'_id_source': self.next_id()} for _ in range(args[0])]
+		if 'SELECT st._id_source_telegram' in query:
+			_id_origin = self.domains.get(args[0])
+			rows = []
+			for _id_source_telegram in args[1]:
+				_id_source = self.source_telegram.get((_id_origin, _id_source_telegram))
+				if _id_source:
+					rows.append({'_id_source_telegram': _id_source_telegram, '_id_source': _id_source, 'is_downloaded': _id_source in self.source_content})
+			return rows
+		if 'INSERT INTO source (' in query:
+			_id_source = self.next_id()
+			self.sources[_id_source] = args[2]
+			return [{'_id_source': _id_source}]
+		if 'INSERT INTO source_telegram' in query:
+			self.source_telegram[(self.sources[args[4]], args[0])] = args[4]
+			return [{'_id_source_telegram': args[0]}]
+		if 'LEFT JOIN origin_schedule' in query:
+			now = datetime.utcnow().replace(tzinfo=pytz.UTC)
+			due = [origin for origin in self.origins.values() if origin.get('next_due') == None or origin['next_due'] <= now]
+			return [dict(origin) for origin in sorted(due, key=lambda origin: (origin.get('next_due') != None, -(origin.get('activity') or 0), origin.get('next_due') or now))]
+		if 'CROSS JOIN LATERAL' in query:
+			return [dict(origin) for origin in self.origins.values()]
+		if 'INSERT INTO origin_schedule' in query:
+			next_due = datetime.utcnow().replace(tzinfo=pytz.UTC) + timedelta(seconds=args[1])
+			self.origins[args[0]].update(next_due=next_due, interval_seconds=args[1], activity=args[2])
+			return [{'next_due': next_due}]
+		if 'INSERT INTO backfill_segment' in query:
+			segments = self.segments.setdefault(args[0], {})
+			for min_id, max_id in zip(args[1], args[2]):
+				segments.setdefault(min_id, {'_id_origin': args[0], 'min_id': min_id, 'max_id': max_id, 'last_checked': min_id})
+			return []
+		if 'SELECT * FROM backfill_segment' in query:
+			return [dict(segment) for segment in sorted(self.segments.get(args[0], {}).values(), key=lambda segment: segment['min_id'])]
+		if 'UPDATE backfill_segment' in query:
+			self.segments[args[0]][args[1]]['last_checked'] = args[2]
+			return [{'last_checked': args[2]}]
+		if 'DELETE FROM backfill_segment' in query:
+			return [{'min_id': min_id} for min_id in self.segments.pop(args[0], {})]
+		if 'UPDATE origin SET last_checked = GREATEST' in query:
+			origin = self.origins[args[1]]
+			origin['last_checked'] = max(origin['last_checked'] or 0, args[0])
+			return [{'last_checked': origin['last_checked']}]
+		if 'UPDATE origin SET last_checked' in query:
+			self.origins[args[1]]['last_checked'] = args[0]
+			return [{'last_checked': args[0]}]
+		if 'SELECT last_checked FROM origin' in query:
+			return [{'last_checked': self.origins[args[0]]['last_checked']}]
+		if 'UPDATE origin SET is_dead_score' in query:
+			self.origins[args[1]]['is_dead_score'] = args[0]
+			return [{'is_dead_score': args[0]}]
+		if 'INSERT INTO origin_history' in query:
+			return [{'_id_origin_history': self.next_id()}]
+		if 'UPDATE origin_history' in query:
+			return [{'_id_origin_history': args[0]}]
+		if 'FROM origin_entity' in query:
+			entity = self.entities.get((args[0], args[1]))
+			return [dict(entity)] if entity else []
+		if 'INSERT INTO origin_entity' in query:
+			self.entities[(args[0], args[1])] = {'_id_origin': args[0], 'channel_id': args[2], 'access_hash': args[3], 'resolved_time': datetime.utcnow().replace(tzinfo=pytz.UTC)}
+			return [{'_id_origin': args[0]}]
+		if 'INNER JOIN content_index' in query:
+			for document_id, size, _id_content in self.source_content.values():
+				if document_id == args[0] and size == args[1]:
+					return [dict(next(content for content in self.contents.values() if content['_id_content'] == _id_content))]
+			return []
+		if 'INSERT INTO content_index' in query:
+			content = self.contents.get(args[0])
+			if content:
+				return [dict(content, is_new=False)]
+			content = self.contents[args[0]] = {'_id_content': self.next_id(), 'file_path': args[2]}
+			return [dict(content, is_new=True)]
+		if 'INSERT INTO source_content' in query:
+			self.source_content[args[0]] = (args[1], args[2], args[3])
+			return [{'_id_content': args[3]}]
+		if 'COUNT(*) FROM analysis_queue' in query:
+			return [{'count': sum(file_path == args[0] or file_path.startswith(args[1]) for file_path in self.analysis_jobs)}]
+		if 'FROM analysis_queue' in query:
+			return []
+		if 'INSERT INTO analysis_queue' in query:
+			self.analysis_jobs.append(args[1])
+			return [{'_id_analysis_queue': self.next_id()}]
+		if 'UPDATE analysis_queue' in query:
+			return [{'attempts': 1}]
+		raise NotImplementedError(query)
+
+
+##############################################################
+### Runs #####################################################
+
+def build_channels(argv):
+	return [FakeChannel(index, argv.Messages, argv.DocumentRatio, argv.FileSize, tgscraper.SUPPORTED_FILETYPES) for index in range(argv.Origins)]
+
+def build_client(argv, channels, seed):
+	return FakeClient(channels, argv.TelegramLatency / 1000, argv.FloodWaitRatio, argv.FloodWaitSeconds, seed)
+
+async def build_pool(argv, channels):
+	if not argv.RealDB:
+		pool = FakePool(argv.DbLatency / 1000)
+		for channel in channels:
+			channel._id_origin = pool.add_origin(channel)
+		return CountingPool(pool)
+
+	pool = await create_async_pool()
+	if not pool:
+		sys.exit('Connection to the DB failed')
+	for channel in channels:
+		# A new domain every run, the real database keeps the sources of the previous ones
+		channel.username = f'{channel.username}_{int(time.time())}'
+		channel._id_origin = await insertOrigin(pool, {'domain': channel.username, 'name': None, 'is_dead_score': 0, 'category': 1})
+		await insertOriginHistory(pool, {'_id_origin': channel._id_origin})
+	return CountingPool(pool)
+
+
+async def fake_node_script(script_path, args=None):
+	await asyncio.sleep(fake_node_script.seconds)
+	return True
+
+
+def patch_analysis(argv):
+	fake_node_script.seconds = argv.AnalysisMs / 1000
+	analyzer.call_node_script = metrics.timed('tgscraper_analysis_seconds')(fake_node_script)
+
+
+# download_supported_files only, origin after origin with MAX_CONCURRENT_ORIGINS of them at the same time
+async def run_scan(argv, root_path):
+	channels = build_channels(argv)
+	pool = await build_pool(argv, channels)
+	client = build_client(argv, channels, argv.Seed)
+
+	analysis_queue = AnalysisQueue(pool, 'halAnalyzeDBs.js', tgscraper.ANALYSIS_WORKERS, tgscraper.ANALYSIS_MAX_ATTEMPTS)
+	floodgate = FloodGate()
+	content_store = ContentStore(pool, root_path)
+	prescreen = PreScreen(client, tgscraper.SUPPORTED_FILETYPES, tgscraper.PRESCREEN_BYTES, tgscraper.PRESCREEN_MIN_SIZE, tgscraper.PRESCREEN_MAX_SIZE, tgscraper.PRESCREEN_ARCHIVES, tgscraper.MAX_CONCURRENT_DOWNLOADS, floodgate) if tgscraper.PRESCREEN else None
+	download_manager = DownloadManager(client, analysis_queue, content_store, tgscraper.MAX_CONCURRENT_DOWNLOADS, tgscraper.DOWNLOAD_CHUNK_SIZE, None, tgscraper.DOWNLOAD_RETRIES, floodgate, prescreen)
+	semaphore = asyncio.Semaphore(max(1, tgscraper.MAX_CONCURRENT_ORIGINS))
+
+	async def scan(channel):
+		async with semaphore:
+			while True:
+				await floodgate.wait()
+				try:
+					return await tgscraper.download_supported_files(pool, client, download_manager, tgscraper.SUPPORTED_FILETYPES, channel._id_origin, channel.username, 0, floodgate)
+				except FloodWaitError as e:
+					floodgate.trip(e.seconds)
+
+	await asyncio.gather(*(scan(channel) for channel in channels))
+	await download_manager.join()
+	await analysis_queue.join()
+	await pool.close()
+	return pool, [client]
+
+
+# The whole tgscraper.main, with the fake clients in place of the logged in accounts
+async def run_main(argv, root_path):
+	channels = build_channels(argv)
+	pool = await build_pool(argv, channels)
+	clients = [build_client(argv, channels, argv.Seed + i) for i in range(argv.Accounts)]
+
+	async def initialize_clients(phone_numbers=None):
+		return [(f'+bench{i}', client) for i, client in enumerate(clients)]
+
+	async def create_pool():
+		return pool
+
+	tgscraper.initialize_clients = initialize_clients
+	tgscraper.create_async_pool = create_pool
+	tgscraper.ROOT_PATH = root_path
+	sys.argv = [sys.argv[0]] # main parses the scraper options
+	await tgscraper.main()
+	await pool.close()
+	return pool, clients
+
+
+def git_version():
+	try:
+		return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		return None
+
+
+async def main():
+	parser = argparse.ArgumentParser("Offline benchmark of the telegram scraper")
+	parser.add_argument('-M', '--Mode', choices=['main', 'scan'], default='main', help = "Run tgscraper.main or download_supported_files only")
+	parser.add_argument('-o', '--Origins', type=int, default=100, help = "Synthetic channels")
+	parser.add_argument('-n', '--Messages', type=int, default=1000, help = "Messages per channel")
+	parser.add_argument('-r', '--DocumentRatio', type=float, default=0.05, help = "Share of the messages with a supported file")
+	parser.add_argument('-s', '--FileSize', type=int, default=4096, help = "Bytes of every file")
+	parser.add_argument('-a', '--Accounts', type=int, default=1, help = "Fake accounts in main mode")
+	parser.add_argument('-fw', '--FloodWaitRatio', type=float, default=0, help = "Chance of a FloodWait on every telegram request")
+	parser.add_argument('-fs', '--FloodWaitSeconds', type=int, default=1)
+	parser.add_argument('-tl', '--TelegramLatency', type=float, default=0, help = "Milliseconds of every telegram request")
+	parser.add_argument('-dl', '--DbLatency', type=float, default=0, help = "Milliseconds of every query on the fake database")
+	parser.add_argument('-am', '--AnalysisMs', type=float, default=0, help = "Milliseconds of every fake analysis")
+	parser.add_argument('--RealDB', action='store_true', help = "Use the database of the .env instead of the fake one, a scratch database only")
+	parser.add_argument('--Seed', type=int, default=1)
+	parser.add_argument('--LogLevel', type=int, default=30, help = "Log level of the scraper, the per message logs slow down the big runs")
+	parser.add_argument('--Output', help = "Append the results as a json line to this file", metavar='')
+	argv = parser.parse_args()
+
+	for module_name in tgscraper.LOGGED_MODULES + ('tgscraper',):
+		logging.getLogger(module_name).setLevel(argv.LogLevel)
+	logging.getLogger('metrics').setLevel(logging.INFO)
+
+	metrics.enable()
+	patch_analysis(argv)
+
+	with tempfile.TemporaryDirectory(prefix='tgbench') as root_path:
+		cwd = os.getcwd()
+		os.chdir(root_path) # main creates its supported_files folder in the working directory
+		start = time.perf_counter()
+		try:
+			if argv.Mode == 'scan':
+				pool, clients = await run_scan(argv, root_path)
+			else:
+				pool, clients = await run_main(argv, root_path)
+		finally:
+			os.chdir(cwd)
+		elapsed = time.perf_counter() - start
+
+	messages = argv.Origins * argv.Messages
+	results = {
+		'version': git_version(),
+		'date': datetime.utcnow().isoformat(),
+		'mode': argv.Mode,
+		'origins': argv.Origins,
+		'messages': messages,
+		'document_ratio': argv.DocumentRatio,
+		'file_size': argv.FileSize,
+		'real_db': argv.RealDB,
+		'seconds': round(elapsed, 3),
+		'messages_per_second': round(messages / elapsed, 1),
+		'db_queries': pool.stats['queries'],
+		'db_round_trips': pool.stats['round_trips'],
+		'db_round_trips_per_message': round(pool.stats['round_trips'] / max(1, messages), 4),
+		'telegram_requests': sum(client.requests for client in clients),
+		'flood_waits': sum(client.flood_waits for client in clients),
+		'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # kilobytes on linux
+	}
+
+	for key, value in results.items():
+		print(f'{key:>28}: {value}')
+
+	if argv.Output:
+		with open(argv.Output, 'a') as f:
+			f.write(json.dumps(results) + '\n')
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
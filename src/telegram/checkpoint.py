@@ -0,0 +1,53 @@
+import logging
+from collections import deque
+
+from db import updateOriginLastChecked
+
+logging = logging.getLogger(__name__)
+
+
+def transfer_succeeded(transfer):
+	return transfer.done() and not transfer.cancelled() and transfer.exception() == None and transfer.result()
+
+
+# Progress of a channel scan. Every flushed batch is recorded with the id of the last scanned message
+# and the downloads it started: last_checked is moved to a batch only when that batch and every batch
+# before it are fully inserted and downloaded, so a resume never skips a message.
+class Checkpoint:
+
+	def __init__(self, pool, _id_origin, domain, last_checked):
+		self.pool = pool
+		self._id_origin = _id_origin
+		self.domain = domain
+		self.persisted = last_checked
+		self._batches = deque() # (message id, transfers) in scan order
+		self._blocked = False
+
+	def add(self, message_id, transfers, committed=True):
+		if not committed:
+			# The inserts of this batch failed, nothing from here on can be checkpointed in this scan
+			self._blocked = True
+		if not self._blocked:
+			self._batches.append((message_id, transfers))
+
+	def safe_id(self):
+		safe_id = self.persisted
+		while self._batches and all(transfer_succeeded(transfer) for transfer in self._batches[0][1]):
+			safe_id = max(safe_id, self._batches.popleft()[0])
+		return safe_id
+
+	async def save(self):
+		safe_id = self.safe_id()
+		if safe_id <= self.persisted:
+			return self.persisted
+
+		persisted = await self._persist(safe_id)
+		if (persisted != None and persisted >= safe_id): # Further on when another scan got there first
+			logging.info('Last checked for origin %s - %s updated at %s', self._id_origin, self.domain, persisted)
+			self.persisted = persisted
+		else:
+			logging.error('Error while updating last_checked for origin %s - %s', self._id_origin, self.domain)
+		return self.persisted
+
+	async def _persist(self, safe_id):
+		return await updateOriginLastChecked(self.pool, safe_id, self._id_origin)
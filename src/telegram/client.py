@@ -2,15 +2,44 @@
 import os
 from telethon.sync import TelegramClient
 
-async def initialize_client():
+# One client (not connected yet) for every account of the pool. Without a pool in config.json the
+# TELEGRAM_PHONE_NUMBER account is the only one
+def build_clients(phone_numbers=None):
 
 	TELEGRAM_API_ID = os.getenv("TELEGRAM_API_ID")
 	TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH")
-	# TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-	TELEGRAM_PHONE_NUMBER = os.getenv("TELEGRAM_PHONE_NUMBER")
-
-	if(TELEGRAM_API_ID and TELEGRAM_API_HASH and TELEGRAM_PHONE_NUMBER):
-		client = TelegramClient(TELEGRAM_PHONE_NUMBER, int(TELEGRAM_API_ID), TELEGRAM_API_HASH)
-		return await client.start(TELEGRAM_PHONE_NUMBER)  # type: ignore
-	else:
-		return None
\ No newline at end of file
+
+	if not phone_numbers:
+		phone_numbers = [os.getenv("TELEGRAM_PHONE_NUMBER")]
+
+	if not (TELEGRAM_API_ID and TELEGRAM_API_HASH and all(phone_numbers)):
+		return None
+
+	return [(phone_number, TelegramClient(phone_number, int(TELEGRAM_API_ID), TELEGRAM_API_HASH)) for phone_number in phone_numbers]
+
+# The clients of build_clients, started
+async def initialize_clients(phone_numbers=None):
+	built = build_clients(phone_numbers)
+	if not built:
+		return None
+
+	clients = []
+	for phone_number, client in built:
+		# Started one at a time, the login can ask for the code on stdin
+		clients.append((phone_number, await client.start(phone_number)))  # type: ignore
+	return clients
+
+# Same clients of initialize_clients without the interactive login, for the processes where stdin is
+# not a terminal. None when an account was never logged in
+async def connect_clients(phone_numbers=None):
+	built = build_clients(phone_numbers)
+	if not built:
+		return None
+
+	for phone_number, client in built:
+		await client.connect()
+		if not await client.is_user_authorized():
+			for _, connected in built:
+				await connected.disconnect()
+			return None
+	return built
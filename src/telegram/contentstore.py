@@ -0,0 +1,67 @@
+import asyncio, hashlib, logging, os
+
+from db import selectContentByDocument, insertContent, insertSourceContent
+
+logging = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024*1024
+
+
+def sha256_file(file_path):
+	digest = hashlib.sha256()
+	with open(file_path, 'rb') as f:
+		while block := f.read(HASH_BLOCK_SIZE):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+# Content addressed storage of the downloaded files. The same leak reposted in many channels keeps
+# its Telegram document id, so most reposts are recognized before downloading anything. When the id
+# is different the SHA-256 of the downloaded file is the fallback. Files live in
+# <root>/<sha256[:2]>/<sha256>.<ext>, so two files with the same name never overwrite each other.
+class ContentStore:
+
+	def __init__(self, pool, root_path):
+		self.pool = pool
+		self.root_path = root_path
+		self.incoming_path = os.path.join(root_path, '.incoming')
+		os.makedirs(self.incoming_path, exist_ok=True)
+		self._document_locks = {} # document id -> lock, the same repost seen in two channels (or by two accounts) is downloaded once
+
+	def document_lock(self, document):
+		return self._document_locks.setdefault(document.id, asyncio.Lock())
+
+	def incoming_file(self, document):
+		return os.path.join(self.incoming_path, str(document.id))
+
+	async def lookup(self, document):
+		return await selectContentByDocument(self.pool, document.id, document.size)
+
+	async def link(self, _id_source, document, _id_content):
+		return await insertSourceContent(self.pool, {
+			'_id_source': _id_source,
+			'document_id': document.id,
+			'size': document.size,
+			'_id_content': _id_content
+		})
+
+	# Moves a completed download in the store. Returns the content row, is_new is false when the same bytes were already there.
+	# The file is in place before its row exists, a row never points to a missing file
+	async def store(self, incoming_file, document, extension):
+		sha256 = await asyncio.to_thread(sha256_file, incoming_file)
+		file_path = os.path.join(self.root_path, sha256[:2], sha256 + extension)
+
+		# Same hash same bytes, replacing a copy already there changes nothing
+		os.makedirs(os.path.dirname(file_path), exist_ok=True)
+		os.replace(incoming_file, file_path)
+
+		content = await insertContent(self.pool, {'sha256': sha256, 'size': document.size, 'file_path': file_path})
+		if content == None:
+			return None
+
+		if not content['is_new'] and content['file_path'] != file_path:
+			# Known under another extension, the row keeps the first one
+			logging.info('Downloaded file already known with hash %s, dropping the copy', sha256)
+			os.remove(file_path)
+
+		return content
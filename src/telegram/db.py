@@ -1,7 +1,8 @@
-import asyncpg
+import asyncpg, json
 from datetime import datetime
 
 from style import style
+from metrics import timed
 
 from dotenv import load_dotenv
 import os
@@ -25,6 +26,7 @@ async def create_async_pool():
 
 
 
+@timed('tgscraper_db_seconds')
 async def insertOrigin(pool, origin):
     try:
         # Take a connection from the pool.
@@ -40,6 +42,7 @@ async def insertOrigin(pool, origin):
         print(style.error(f"Unexpected error while inserting a new origin: {e}"))
         return None
 
+@timed('tgscraper_db_seconds')
 async def insertSource(pool, source, source_telegram):
     try:
         async with pool.acquire() as conn:
@@ -65,6 +68,33 @@ async def insertSource(pool, source, source_telegram):
         return None
     
 
+@timed('tgscraper_db_seconds')
+async def insertSources(pool, sources):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Reserve the serial ids first, so both tables can be loaded with COPY and source_telegram can point to its source
+                reserved = await conn.fetch("SELECT nextval(pg_get_serial_sequence('source', '_id_source')) AS _id_source FROM generate_series(1, $1)", len(sources))
+                _ids_source = [row['_id_source'] for row in reserved]
+
+                await conn.copy_records_to_table('source',
+                    records=[(_id_source, source['spam_score'], source['published_time'], source['_id_origin'], source['_id_author']) for _id_source, (source, _) in zip(_ids_source, sources)],
+                    columns=['_id_source', 'spam_score', 'published_time', '_id_origin', '_id_author'])
+
+                await conn.copy_records_to_table('source_telegram',
+                    records=[(source_telegram['_id_source_telegram'], source_telegram['message_text'], source_telegram['views_count'], source_telegram['shares_count'], _id_source) for _id_source, (_, source_telegram) in zip(_ids_source, sources)],
+                    columns=['_id_source_telegram', 'message_text', 'views_count', 'shares_count', '_id_source'])
+
+                # _id_source_telegram -> _id_source
+                return {source_telegram['_id_source_telegram']: _id_source for _id_source, (_, source_telegram) in zip(_ids_source, sources)}
+
+    except Exception as e:
+        # The whole batch is rolled back by the transaction
+        print(style.error(f"Unexpected error while inserting a batch of {len(sources)} sources: {e}"))
+        return None
+
+
+@timed('tgscraper_db_seconds')
 async def selectSourceTegramByDomainAndMessage(pool, domain, _id_source_telegram):
     try:
         # Take a connection from the pool.
@@ -83,17 +113,55 @@ async def selectSourceTegramByDomainAndMessage(pool, domain, _id_source_telegram
         print(style.error(f"Unexpected error while selecting the origin for the domain: {domain}\n{e}"))
         return None
 
+@timed('tgscraper_db_seconds')
+async def selectSourceTelegramIdsByDomain(pool, domain, _ids_source_telegram):
+    try:
+        # Take a connection from the pool.
+        async with pool.acquire() as conn:
+            # Open a transaction.
+            async with conn.transaction():
+                # Same check of selectSourceTegramByDomainAndMessage but for a whole window of messages in a single round-trip.
+                # is_downloaded is false when the file was never linked to the source, so the download can be resumed.
+                # A queued analysis is not enough: the link comes after the enqueue, a crash in between is fixed by the next download
+                return await conn.fetch('''
+                                        SELECT st._id_source_telegram, s._id_source,
+                                            EXISTS (SELECT 1 FROM source_content sc WHERE sc._id_source = s._id_source) AS is_downloaded
+                                            FROM origin o
+                                            INNER JOIN source s ON o._id_origin = s._id_origin
+                                            INNER JOIN source_telegram st ON s._id_source = st._id_source
+                                                WHERE o.domain = $1
+                                                AND st._id_source_telegram = ANY($2::int[])
+                                        ''', str(domain), list(_ids_source_telegram))
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the sources for the domain: {domain}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
 async def insertOriginHistory(pool, origin_history):
     try:
         async with pool.acquire() as conn:
             async with conn.transaction():
-                res = await conn.fetchrow('INSERT INTO origin_history (additional_infos, _id_origin) VALUES ($1, $2) RETURNING _id_origin_history', origin_history['additional_infos'], origin_history['_id_origin'])
+                parsed_infos = json.dumps(origin_history['parsed_infos'], default=str) if origin_history.get('parsed_infos') else None
+                res = await conn.fetchrow('INSERT INTO origin_history (additional_infos, parsed_infos, _id_origin) VALUES ($1, $2::jsonb, $3) RETURNING _id_origin_history', origin_history.get('additional_infos'), parsed_infos, origin_history['_id_origin'])
                 return res['_id_origin_history']
     except Exception as e:
         print(style.error(f"Unexpected error while inserting a new origin history: {e}"))
         return None
 
 
+@timed('tgscraper_db_seconds')
+async def updateOriginHistoryTime(pool, _id_origin_history):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Nothing changed since the last snapshot, only mark it as fresh
+                res = await conn.fetchrow('UPDATE origin_history SET updated_time = CURRENT_TIMESTAMP WHERE _id_origin_history = $1 RETURNING _id_origin_history', _id_origin_history)
+                return res['_id_origin_history']
+    except Exception as e:
+        print(style.error(f"Unexpected error while updating the origin history id: {_id_origin_history}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
 async def selectOriginByDomain(pool, domain):
     try:
         # Take a connection from the pool.
@@ -106,6 +174,45 @@ async def selectOriginByDomain(pool, domain):
         print(style.error(f"Unexpected error while selecting the origin for the domain: {domain}\n{e}"))
         return None
     
+@timed('tgscraper_db_seconds')
+async def selectOriginsByDomains(pool, domains):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Existance check of a whole import list in a single round-trip
+                return await conn.fetch('SELECT _id_origin, domain FROM origin WHERE category = 1 AND domain = ANY($1::varchar[])', [str(domain) for domain in domains])
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the origins by domains: {e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def insertOriginsWithHistory(pool, origins):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # The origins and their first history in one transaction, with one statement per table
+                res = await conn.fetch('''INSERT INTO origin (domain, name, is_dead_score, category)
+                                            SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::int[], $4::int[])
+                                            RETURNING _id_origin, domain''',
+                    [str(origin['domain']) for origin in origins], [origin['name'] for origin in origins],
+                    [origin['is_dead_score'] for origin in origins], [origin['category'] for origin in origins])
+                _ids_origin = {row['domain']: row['_id_origin'] for row in res}
+
+                res = await conn.fetch('''INSERT INTO origin_history (parsed_infos, _id_origin)
+                                            SELECT parsed_infos::jsonb, _id_origin FROM unnest($1::text[], $2::int[]) AS t(parsed_infos, _id_origin)
+                                            RETURNING _id_origin_history, _id_origin''',
+                    [json.dumps(origin['parsed_infos'], default=str) if origin.get('parsed_infos') else None for origin in origins],
+                    [_ids_origin[str(origin['domain'])] for origin in origins])
+                _ids_origin_history = {row['_id_origin']: row['_id_origin_history'] for row in res}
+
+                # domain -> (_id_origin, _id_origin_history)
+                return {domain: (_id_origin, _ids_origin_history[_id_origin]) for domain, _id_origin in _ids_origin.items()}
+    except Exception as e:
+        # The whole batch is rolled back by the transaction
+        print(style.error(f"Unexpected error while inserting a batch of origins: {e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
 async def selectOrigins(pool):
     try:
         # Take a connection from the pool.
@@ -113,21 +220,61 @@ async def selectOrigins(pool):
             # Open a transaction.
             async with conn.transaction():
                 # Run the query passing the request argument.
+                # Latest history of every telegram origin, a single index probe on origin_history(_id_origin, updated_time DESC) per origin
                 return await conn.fetch('''SELECT * FROM origin o
-                                            JOIN origin_history oh
-                                            ON oh._id_origin = o._id_origin
-                                            AND oh.updated_time = (
-                                                SELECT MAX(z.updated_time) 
-                                                FROM origin_history z 
-                                                WHERE o.category = 1
-                                                AND z._id_origin = o._id_origin
-                                            )''')
+                                            CROSS JOIN LATERAL (
+                                                SELECT * FROM origin_history z
+                                                WHERE z._id_origin = o._id_origin
+                                                ORDER BY z.updated_time DESC
+                                                LIMIT 1
+                                            ) oh
+                                            WHERE o.category = 1''')
     except Exception as e:
         print(style.error(f"Unexpected error while selecting origins: {e}"))
         return None
     
 
 
+@timed('tgscraper_db_seconds')
+async def selectDueOrigins(pool):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Same rows of selectOrigins, only the origins due for a check. The never checked ones come first,
+                # then the most active, then the most overdue
+                return await conn.fetch('''SELECT o.*, oh.*, s.next_due, s.interval_seconds, s.activity FROM origin o
+                                            CROSS JOIN LATERAL (
+                                                SELECT * FROM origin_history z
+                                                WHERE z._id_origin = o._id_origin
+                                                ORDER BY z.updated_time DESC
+                                                LIMIT 1
+                                            ) oh
+                                            LEFT JOIN origin_schedule s ON s._id_origin = o._id_origin
+                                            WHERE o.category = 1
+                                            AND (s.next_due IS NULL OR s.next_due <= CURRENT_TIMESTAMP)
+                                            ORDER BY s.next_due IS NOT NULL, s.activity DESC, s.next_due''')
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the due origins: {e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def upsertOriginSchedule(pool, origin_schedule):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('''INSERT INTO origin_schedule (_id_origin, next_due, interval_seconds, activity, new_messages, new_files)
+                                            VALUES ($1, CURRENT_TIMESTAMP + make_interval(secs => $2), $2, $3, $4, $5)
+                                            ON CONFLICT (_id_origin) DO UPDATE
+                                                SET next_due = EXCLUDED.next_due, interval_seconds = EXCLUDED.interval_seconds, activity = EXCLUDED.activity,
+                                                    new_messages = EXCLUDED.new_messages, new_files = EXCLUDED.new_files, checked_time = CURRENT_TIMESTAMP
+                                            RETURNING next_due''',
+                    origin_schedule['_id_origin'], origin_schedule['interval_seconds'], origin_schedule['activity'], origin_schedule['new_messages'], origin_schedule['new_files'])
+                return res['next_due']
+    except Exception as e:
+        print(style.error(f"Unexpected error while updating the schedule of an origin: {e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
 async def updateOriginDeadScore(pool, is_dead_score, _id_origin):
     try:
         # Take a connection from the pool.
@@ -141,6 +288,7 @@ async def updateOriginDeadScore(pool, is_dead_score, _id_origin):
         print(style.error(f"Unexpected error while updating is_dead_score for origin id: {_id_origin}\n{e}"))
         return None
     
+@timed('tgscraper_db_seconds')
 async def updateOriginLastChecked(pool, last_checked, _id_origin):
     try:
         # Take a connection from the pool.
@@ -148,8 +296,228 @@ async def updateOriginLastChecked(pool, last_checked, _id_origin):
             # Open a transaction.
             async with conn.transaction():
                 # Run the query passing the request argument.
-                res = await conn.fetchrow('UPDATE origin SET last_checked = $1 WHERE _id_origin = $2 RETURNING last_checked', last_checked, _id_origin)
+                # Never backwards: a stale scan (a retry, the daemon and the sweep) can't undo a newer checkpoint
+                res = await conn.fetchrow('UPDATE origin SET last_checked = GREATEST(last_checked, $1) WHERE _id_origin = $2 RETURNING last_checked', last_checked, _id_origin)
                 return res['last_checked']
     except Exception as e:
         print(style.error(f"Unexpected error while updating last_checked for origin id: {_id_origin}\n{e}"))
-        return None
\ No newline at end of file
+        return None
+
+@timed('tgscraper_db_seconds')
+async def selectOriginLastChecked(pool, _id_origin):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('SELECT last_checked FROM origin WHERE _id_origin = $1', _id_origin)
+                return res['last_checked']
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting last_checked for origin id: {_id_origin}\n{e}"))
+        return None
+
+
+@timed('tgscraper_db_seconds')
+async def insertAnalysisJob(pool, _id_source, file_path):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('INSERT INTO analysis_queue (_id_source, file_path) VALUES ($1, $2) RETURNING _id_analysis_queue', _id_source, file_path)
+                return res['_id_analysis_queue']
+    except Exception as e:
+        print(style.error(f"Unexpected error while queueing the analysis for source id: {_id_source}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def selectPendingAnalysisJobs(pool, max_attempts):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Running jobs are still there only if the previous run died while analyzing them, also during their last attempt
+                return await conn.fetch('''SELECT * FROM analysis_queue
+                                            WHERE (status = 0 AND attempts < $1)
+                                            OR status = 1
+                                            ORDER BY _id_analysis_queue''', max_attempts)
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the pending analysis jobs: {e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def selectAnalysisJobCount(pool, file_path):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Jobs of the stored file or of the members extracted from it (<file_path>.d/), failed ones excluded
+                return await conn.fetchval('''SELECT COUNT(*) FROM analysis_queue
+                                            WHERE status IN (0, 1, 2)
+                                            AND (file_path = $1 OR left(file_path, length($2)) = $2)''', file_path, file_path + '.d' + os.sep)
+    except Exception as e:
+        print(style.error(f"Unexpected error while counting the analysis jobs of {file_path}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def updateAnalysisJobStatus(pool, _id_analysis_queue, status, new_attempt=False):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('''UPDATE analysis_queue
+                                            SET status = $1, attempts = attempts + $2, updated_time = CURRENT_TIMESTAMP
+                                            WHERE _id_analysis_queue = $3
+                                            RETURNING attempts''', status, int(new_attempt), _id_analysis_queue)
+                return res['attempts']
+    except Exception as e:
+        print(style.error(f"Unexpected error while updating the analysis job id: {_id_analysis_queue}\n{e}"))
+        return None
+
+
+@timed('tgscraper_db_seconds')
+async def selectContentByDocument(pool, document_id, size):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                return await conn.fetchrow('''SELECT ci.* FROM source_content sc
+                                                INNER JOIN content_index ci ON sc._id_content = ci._id_content
+                                                WHERE sc.document_id = $1
+                                                AND sc.size = $2
+                                                LIMIT 1''', document_id, size)
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the content for the document id: {document_id}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def insertContent(pool, content):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Two origins can finish the same file at the same time, the second one gets the row of the first.
+                # is_new is true only for the one that actually created it
+                res = await conn.fetchrow('''INSERT INTO content_index (sha256, size, file_path) VALUES ($1, $2, $3)
+                                            ON CONFLICT (sha256) DO UPDATE SET sha256 = EXCLUDED.sha256
+                                            RETURNING _id_content, file_path, (xmax = 0) AS is_new''', content['sha256'], content['size'], content['file_path'])
+                return res
+    except Exception as e:
+        print(style.error(f"Unexpected error while inserting the content {content['sha256']}: {e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def insertSourceContent(pool, source_content):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('''INSERT INTO source_content (_id_source, document_id, size, _id_content) VALUES ($1, $2, $3, $4)
+                                            ON CONFLICT (_id_source) DO UPDATE SET _id_content = EXCLUDED._id_content
+                                            RETURNING _id_content''', source_content['_id_source'], source_content['document_id'], source_content['size'], source_content['_id_content'])
+                return res['_id_content']
+    except Exception as e:
+        print(style.error(f"Unexpected error while linking the source id: {source_content['_id_source']} to its content\n{e}"))
+        return None
+
+
+@timed('tgscraper_db_seconds')
+async def selectOriginEntity(pool, _id_origin, account):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                return await conn.fetchrow('SELECT * FROM origin_entity WHERE _id_origin = $1 AND account = $2', _id_origin, account)
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the cached entity for origin id: {_id_origin}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def upsertOriginEntity(pool, origin_entity):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('''INSERT INTO origin_entity (_id_origin, account, channel_id, access_hash, metadata) VALUES ($1, $2, $3, $4, $5::jsonb)
+                                            ON CONFLICT (_id_origin, account) DO UPDATE
+                                                SET channel_id = EXCLUDED.channel_id, access_hash = EXCLUDED.access_hash, metadata = EXCLUDED.metadata, resolved_time = CURRENT_TIMESTAMP
+                                            RETURNING _id_origin''',
+                    origin_entity['_id_origin'], origin_entity['account'], origin_entity['channel_id'], origin_entity['access_hash'], json.dumps(origin_entity['metadata'], default=str))
+                return res['_id_origin']
+    except Exception as e:
+        print(style.error(f"Unexpected error while caching the entity for origin id: {origin_entity['_id_origin']}\n{e}"))
+        return None
+
+
+# What a message must match and how it ranks, per search mode. Fixed strings, the query is always a parameter
+SEARCH_MODES = {
+    # Keywords, websearch syntax: "exact phrase", -excluded, or
+    'text': ("st.message_tsv @@ websearch_to_tsquery('simple', $1)", "ts_rank(st.message_tsv, websearch_to_tsquery('simple', $1))"),
+    # Any part of a word, the trigram index covers the ILIKE. %, _ and \ in the query are literal
+    'substring': (r"st.message_text ILIKE '%' || replace(replace(replace($1, '\', '\\'), '%', '\%'), '_', '\_') || '%'", "word_similarity($1, st.message_text)")
+}
+
+@timed('tgscraper_db_seconds')
+async def searchMessages(pool, query, mode='text', _id_origin=None, since=None, until=None, after=None, limit=20):
+    match, rank = SEARCH_MODES[mode]
+    after = after or {}
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Best ranked first, the ids break the ties. after is the last row of the previous page (keyset, no OFFSET)
+                return await conn.fetch(f'''
+                                        SELECT st._id_source, st._id_source_telegram, st.message_text, s._id_origin, o.domain, s.published_time, r.rank
+                                            FROM source_telegram st
+                                            INNER JOIN source s ON s._id_source = st._id_source
+                                            INNER JOIN origin o ON o._id_origin = s._id_origin
+                                            CROSS JOIN LATERAL (SELECT ({rank})::float8 AS rank) r
+                                                WHERE {match}
+                                                AND ($2::int IS NULL OR s._id_origin = $2)
+                                                AND ($3::timestamptz IS NULL OR s.published_time >= $3)
+                                                AND ($4::timestamptz IS NULL OR s.published_time < $4)
+                                                AND ($5::float8 IS NULL OR (r.rank, st._id_source, st._id_source_telegram) < ($5, $6, $7))
+                                            ORDER BY r.rank DESC, st._id_source DESC, st._id_source_telegram DESC
+                                            LIMIT $8
+                                        ''', query, _id_origin, since, until, after.get('rank'), after.get('_id_source'), after.get('_id_source_telegram'), limit)
+    except Exception as e:
+        print(style.error(f"Unexpected error while searching the messages for: {query}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def selectBackfillSegments(pool, _id_origin):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                return await conn.fetch('SELECT * FROM backfill_segment WHERE _id_origin = $1 ORDER BY min_id', _id_origin)
+    except Exception as e:
+        print(style.error(f"Unexpected error while selecting the backfill segments of origin id: {_id_origin}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def insertBackfillSegments(pool, _id_origin, segments):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Every segment starts from its min_id. A plan already there is kept with its progress
+                await conn.fetch('''INSERT INTO backfill_segment (_id_origin, min_id, max_id, last_checked)
+                                        SELECT $1, segment.min_id, segment.max_id, segment.min_id FROM unnest($2::int[], $3::int[]) AS segment(min_id, max_id)
+                                    ON CONFLICT DO NOTHING
+                                    RETURNING min_id''',
+                    _id_origin, [min_id for min_id, _ in segments], [max_id for _, max_id in segments])
+                return await conn.fetch('SELECT * FROM backfill_segment WHERE _id_origin = $1 ORDER BY min_id', _id_origin)
+    except Exception as e:
+        print(style.error(f"Unexpected error while inserting the backfill segments of origin id: {_id_origin}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def updateBackfillSegment(pool, _id_origin, min_id, last_checked):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetchrow('UPDATE backfill_segment SET last_checked = GREATEST(last_checked, $3), updated_time = CURRENT_TIMESTAMP WHERE _id_origin = $1 AND min_id = $2 RETURNING last_checked',
+                    _id_origin, min_id, last_checked)
+                return res['last_checked']
+    except Exception as e:
+        print(style.error(f"Unexpected error while updating the backfill segment {min_id} of origin id: {_id_origin}\n{e}"))
+        return None
+
+@timed('tgscraper_db_seconds')
+async def completeBackfill(pool, _id_origin, last_checked):
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Every segment is done: the regular scans go on from the head of the channel at the start of the backfill
+                res = await conn.fetchrow('UPDATE origin SET last_checked = $1 WHERE _id_origin = $2 RETURNING last_checked', last_checked, _id_origin)
+                await conn.fetch('DELETE FROM backfill_segment WHERE _id_origin = $1 RETURNING min_id', _id_origin)
+                return res['last_checked']
+    except Exception as e:
+        print(style.error(f"Unexpected error while completing the backfill of origin id: {_id_origin}\n{e}"))
+        return None
@@ -0,0 +1,154 @@
+import asyncio, logging, os, time
+
+from telethon.errors import FloodWaitError
+
+import metrics
+from prescreen import is_archive, extract_supported
+
+logging = logging.getLogger(__name__)
+
+PART_SUFFIX = '.part'
+
+
+# Token bucket of the download bandwidth, one for the whole process: every account's DownloadManager
+# draws from the same one, so the cap stays global whatever the number of accounts
+class Bandwidth:
+
+	def __init__(self, max_bytes_per_second=0):
+		self.max_bytes_per_second = max_bytes_per_second # 0 means no cap
+		self._allowance = max_bytes_per_second
+		self._last_refill = None
+
+	async def throttle(self, size):
+		if not self.max_bytes_per_second:
+			return
+
+		now = asyncio.get_running_loop().time()
+		if self._last_refill != None:
+			self._allowance = min(self.max_bytes_per_second, self._allowance + (now - self._last_refill) * self.max_bytes_per_second)
+		self._last_refill = now
+
+		self._allowance -= size
+		if self._allowance < 0:
+			await asyncio.sleep(-self._allowance / self.max_bytes_per_second)
+
+
+# Handles the transfers of the supported files. Every file is written to <file>.part and renamed
+# only once complete, so the analyzer never sees half a file and an interrupted transfer restarts
+# from the bytes already on disk. Documents already in the content store are only linked to the
+# new source, new contents are handed to the analysis queue.
+class DownloadManager:
+
+	def __init__(self, client, analysis_queue, content_store, max_transfers=3, chunk_size=512*1024, bandwidth=None, retries=3, floodgate=None, prescreen=None):
+		self.client = client
+		self.prescreen = prescreen # Decides on the new candidates from their first KB, None downloads them all
+		self.analysis_queue = analysis_queue
+		self.content_store = content_store
+		self.chunk_size = chunk_size
+		self.bandwidth = bandwidth # Shared Bandwidth, None means no cap
+		self.retries = retries
+		self.floodgate = floodgate
+		self._semaphore = asyncio.Semaphore(max(1, max_transfers))
+		self._tasks = set()
+		self._in_flight = {} # _id_source -> task
+
+	def schedule(self, message, file_name, _id_source):
+		# A retried scan can ask again for a file that is still transferring, never write the same .part twice
+		if _id_source in self._in_flight:
+			return self._in_flight[_id_source]
+
+		task = asyncio.create_task(self.download(message, file_name, _id_source))
+		self._tasks.add(task)
+		self._in_flight[_id_source] = task
+		task.add_done_callback(self._tasks.discard)
+		task.add_done_callback(lambda _: self._in_flight.pop(_id_source, None))
+		return task
+
+	async def download(self, message, file_name, _id_source):
+		document = message.media.document
+
+		async with self.content_store.document_lock(document):
+
+			content = await self.content_store.lookup(document)
+			if content:
+				logging.info('%s already stored as %s, linking source ID: %s without downloading it', file_name, content['file_path'], _id_source)
+				return await self.content_store.link(_id_source, document, content['_id_content']) != None
+
+			incoming_file = self.content_store.incoming_file(document)
+			if not await self._download_with_retries(document, incoming_file, file_name):
+				return False
+
+			content = await self.content_store.store(incoming_file, document, os.path.splitext(file_name)[1].lower())
+			if content == None:
+				logging.error('Error while storing %s for source ID: %s', file_name, _id_source)
+				return False
+
+			# Queue first: if we die before the link the next scan downloads it again and matches the hash. If we died
+			# before queueing too, the known content has no job yet and is queued then
+			if content['is_new'] or not await self.analysis_queue.is_queued(content['file_path']):
+				for file_path in await self._analysis_targets(content['file_path']):
+					await self.analysis_queue.enqueue(_id_source, file_path)
+
+			return await self.content_store.link(_id_source, document, content['_id_content']) != None
+
+	# The archives let through by the pre-screen are analyzed through their supported members
+	async def _analysis_targets(self, file_path):
+		if not (self.prescreen and is_archive(file_path, self.prescreen.supported_filetypes)):
+			return [file_path]
+
+		extracted = await asyncio.to_thread(extract_supported, file_path, self.prescreen.supported_filetypes)
+		if not extracted:
+			logging.warning('No supported file extracted from %s, nothing to analyze', file_path)
+		return extracted
+
+	async def _download_with_retries(self, document, file_path, file_name):
+		async with self._semaphore:
+			for attempt in range(self.retries + 1):
+				if self.floodgate:
+					await self.floodgate.wait()
+				try:
+					await self._transfer(document, file_path)
+					logging.info('Download of %s completed', file_name)
+					return True
+				except FloodWaitError as e:
+					if self.floodgate:
+						self.floodgate.trip(e.seconds)
+					else:
+						await asyncio.sleep(e.seconds)
+				except Exception as e:
+					logging.warning('Transfer of %s interrupted (attempt %s/%s): %s', file_name, attempt + 1, self.retries + 1, e)
+
+			logging.error('Download of %s failed, the partial file is kept to resume it later', file_name)
+			return False
+
+	async def _transfer(self, document, file_path):
+		part_path = file_path + PART_SUFFIX
+
+		offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+		offset -= offset % self.chunk_size # Telegram is happier with offsets aligned to the request size
+
+		if offset:
+			logging.info('Resuming %s from byte %s of %s', file_path, offset, document.size)
+
+		start = time.perf_counter()
+		with open(part_path, 'r+b' if offset else 'wb') as f:
+			f.truncate(offset)
+			f.seek(offset)
+			async for chunk in self.client.iter_download(document, offset=offset, request_size=self.chunk_size):
+				f.write(chunk)
+				metrics.inc('tgscraper_download_bytes_total', len(chunk))
+				if self.bandwidth:
+					await self.bandwidth.throttle(len(chunk))
+
+		if os.path.getsize(part_path) != document.size:
+			raise IOError(f'expected {document.size} bytes, got {os.path.getsize(part_path)}')
+		metrics.observe('tgscraper_download_seconds', time.perf_counter() - start)
+
+		os.replace(part_path, file_path)
+
+	def pending(self):
+		return len(self._tasks)
+
+	async def join(self):
+		while self._tasks:
+			await asyncio.gather(*list(self._tasks), return_exceptions=True)
@@ -0,0 +1,71 @@
+import json, logging
+from datetime import datetime, timedelta
+
+import pytz
+from telethon.tl.types import InputPeerChannel
+
+from db import selectOriginEntity, upsertOriginEntity
+from sentinel import get_channel_entity, get_channel_info, parse_channel_info, is_channel_alive
+
+logging = logging.getLogger(__name__)
+
+
+# Resolved channels (id + access_hash, different for every account) and their last metadata, saved in origin_entity.
+# While the cache is fresh an origin costs a single cheap liveness check, when it expired a get_entity.
+# The get_entity + GetFullChannelRequest pair is sent only when the caller needs the full infos.
+class EntityCache:
+
+	def __init__(self, pool, ttl_seconds):
+		self.pool = pool
+		self.ttl = timedelta(seconds=ttl_seconds)
+
+	def is_fresh(self, cached):
+		return (datetime.utcnow().replace(tzinfo=pytz.UTC) - cached['resolved_time']) < self.ttl
+
+	# Returns (peer, full infos or None). Peer is None when the channel does not respond
+	async def resolve(self, client, account, _id_origin, domain, full=False):
+		if full:
+			return await self.resolve_full(client, account, _id_origin, domain)
+
+		cached = await selectOriginEntity(self.pool, _id_origin, account)
+		if cached and self.is_fresh(cached):
+			peer = InputPeerChannel(cached['channel_id'], cached['access_hash'])
+			if await is_channel_alive(client, peer):
+				return peer, None
+			logging.info('Cached entity of origin_id: %s - %s is not valid anymore, resolving it again', _id_origin, domain)
+
+		# The scrape only needs id + access_hash, a get_entity is enough. The metadata stays the one of the last full resolve
+		entity = await get_channel_entity(client=client, channel_username=domain)
+		if not entity:
+			return None, None
+
+		metadata = cached['metadata'] if cached else {'channel_id': entity.id, 'access_hash': entity.access_hash}
+		if isinstance(metadata, str):
+			metadata = json.loads(metadata)
+		await upsertOriginEntity(self.pool, {
+			'_id_origin': _id_origin,
+			'account': account,
+			'channel_id': entity.id,
+			'access_hash': entity.access_hash,
+			'metadata': metadata
+		})
+		return InputPeerChannel(entity.id, entity.access_hash), None
+
+	# get_entity + GetFullChannelRequest, for the origin_history
+	async def resolve_full(self, client, account, _id_origin, domain):
+		additional_infos = await get_channel_info(client=client, channel_username=domain)
+		if not additional_infos:
+			return None, None
+
+		parsed_additional_infos = await parse_channel_info(additional_infos)
+		if not parsed_additional_infos:
+			return domain, additional_infos
+
+		await upsertOriginEntity(self.pool, {
+			'_id_origin': _id_origin,
+			'account': account,
+			'channel_id': parsed_additional_infos['channel_id'],
+			'access_hash': parsed_additional_infos['access_hash'],
+			'metadata': parsed_additional_infos
+		})
+		return InputPeerChannel(parsed_additional_infos['channel_id'], parsed_additional_infos['access_hash']), additional_infos
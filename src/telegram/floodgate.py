@@ -0,0 +1,46 @@
+import asyncio, logging
+
+import metrics
+
+logging = logging.getLogger(__name__)
+
+# Shared backoff for a single telegram client. When one of the workers gets a FloodWait
+# the whole gate is closed, so every other worker stops before its next request instead
+# of hitting the same limit and making the wait even longer.
+class FloodGate:
+
+	def __init__(self):
+		self._open = asyncio.Event()
+		self._open.set()
+		self._reopen_at = 0.0
+		self.total_wait_seconds = 0
+
+	def is_open(self):
+		return self._open.is_set()
+
+	def trip(self, seconds):
+		loop = asyncio.get_running_loop()
+		reopen_at = loop.time() + seconds
+		self.total_wait_seconds += seconds
+		metrics.inc('tgscraper_floodwait_total')
+		metrics.inc('tgscraper_floodwait_seconds_total', seconds)
+
+		if reopen_at > self._reopen_at:
+			self._reopen_at = reopen_at
+
+		if self._open.is_set():
+			logging.warning('FloodWait of %s seconds received, pausing every worker on this client', seconds)
+			self._open.clear()
+			loop.create_task(self._reopen())
+
+	async def _reopen(self):
+		loop = asyncio.get_running_loop()
+		# The deadline can be pushed forward by other FloodWaits while we sleep
+		while (delay := self._reopen_at - loop.time()) > 0:
+			await asyncio.sleep(delay)
+		logging.info('FloodWait expired, resuming the workers')
+		self._open.set()
+
+	async def wait(self):
+		if not self._open.is_set():
+			await self._open.wait()
@@ -0,0 +1,152 @@
+import asyncio, json, os, re, sys
+
+from telethon.errors import FloodWaitError
+
+from style import style
+from db import selectOriginsByDomains, insertOriginsWithHistory
+from sentinel import get_channel_info, parse_channel_info
+from floodgate import FloodGate
+
+# Bulk import tuning, optional in config.json
+IMPORT_CONCURRENCY = 4 # Channels resolved at the same time
+IMPORT_REQUESTS_PER_SECOND = 1 # Resolves started per second, the login and flood budget is the same of the scraper
+IMPORT_BATCH_SIZE = 50 # Origins inserted in a single transaction
+FLOOD_WAIT_RETRIES = 3
+
+config_path = os.path.join(os.path.dirname(__file__), '../../config.json')
+if os.path.exists(config_path):
+	with open(config_path) as f:
+		config = json.load(f).get("Telegram", {})
+		IMPORT_CONCURRENCY = config.get("IMPORT_CONCURRENCY", IMPORT_CONCURRENCY)
+		IMPORT_REQUESTS_PER_SECOND = config.get("IMPORT_REQUESTS_PER_SECOND", IMPORT_REQUESTS_PER_SECOND)
+		IMPORT_BATCH_SIZE = config.get("IMPORT_BATCH_SIZE", IMPORT_BATCH_SIZE)
+		FLOOD_WAIT_RETRIES = config.get("FLOOD_WAIT_RETRIES", FLOOD_WAIT_RETRIES)
+
+
+def parse_domain(domain):
+	if re.match(r"^-[0-9]{13}$", domain):
+		return int(domain)
+	return domain
+
+
+# One origin per line, blank lines and # comments are skipped
+def read_origins(file_path):
+	f = sys.stdin if file_path == '-' else open(file_path)
+	with f:
+		lines = [line.strip() for line in f]
+	return [line for line in lines if line and not line.startswith('#')]
+
+
+# Same steps of --AddOrigin for a whole list: a single existance query, the channels resolved a few at
+# a time under a rate limit, the new origins inserted in batches. Returns one result for every entry
+async def import_origins(pool, client, entries):
+	report = []
+	to_check = {} # domain -> result
+
+	for entry in entries:
+		result = {'origin': entry, 'status': None, '_id_origin': None, '_id_origin_history': None}
+		report.append(result)
+		domain = parse_domain(entry)
+		if str(domain) in to_check:
+			result['status'] = 'duplicate'
+		else:
+			result['domain'] = domain
+			to_check[str(domain)] = result
+
+	rows = await selectOriginsByDomains(pool, list(to_check))
+	if rows == None:
+		for result in to_check.values():
+			result['status'] = 'error'
+		return report
+
+	for row in rows:
+		result = to_check.pop(row['domain'], None)
+		if result: # The same domain can be there twice from the single --AddOrigin
+			result['status'] = 'exists'
+			result['_id_origin'] = row['_id_origin']
+
+	print(style.sysinfo(f"{len(rows)} origins already present, resolving the other {len(to_check)}"))
+
+	floodgate = FloodGate()
+	semaphore = asyncio.Semaphore(max(1, IMPORT_CONCURRENCY))
+	next_request = 0.0
+	batch = []
+
+	async def throttle():
+		nonlocal next_request
+		if not IMPORT_REQUESTS_PER_SECOND:
+			return
+		loop = asyncio.get_running_loop()
+		start = max(loop.time(), next_request)
+		next_request = start + 1 / IMPORT_REQUESTS_PER_SECOND
+		await asyncio.sleep(start - loop.time())
+
+	async def flush():
+		nonlocal batch
+		results, batch = batch, []
+		if not results:
+			return
+
+		inserted = await insertOriginsWithHistory(pool, [{
+			'domain': result['domain'],
+			'name': None,
+			'is_dead_score': 0,
+			'category': 1, # 0 cleanweb, 1 telegram, 2 dark
+			'parsed_infos': result.pop('parsed_infos')
+		} for result in results])
+
+		for result in results:
+			if inserted == None:
+				result['status'] = 'error'
+			else:
+				result['status'] = 'added'
+				result['_id_origin'], result['_id_origin_history'] = inserted[str(result['domain'])]
+
+	async def resolve(result):
+		async with semaphore:
+			for attempt in range(FLOOD_WAIT_RETRIES + 1):
+				await floodgate.wait()
+				await throttle()
+				try:
+					additional_infos = await get_channel_info(client, result['domain'])
+					break
+				except FloodWaitError as e:
+					floodgate.trip(e.seconds)
+			else:
+				result['status'] = 'flood_wait'
+				return
+
+		if not additional_infos:
+			result['status'] = 'unresolved'
+			return
+
+		result['parsed_infos'] = await parse_channel_info(additional_infos)
+		batch.append(result)
+		if len(batch) >= IMPORT_BATCH_SIZE:
+			await flush()
+
+	await asyncio.gather(*(resolve(result) for result in to_check.values()))
+	await flush()
+
+	for result in report:
+		result.pop('domain', None)
+	return report
+
+
+def print_report(report):
+	for result in report:
+		if result['status'] == 'added':
+			print(style.success(f"{result['origin']}: added with ID: {result['_id_origin']}, origin history ID: {result['_id_origin_history']}"))
+		elif result['status'] == 'exists':
+			print(style.info(f"{result['origin']}: already present in the db with ID: {result['_id_origin']}"))
+		elif result['status'] == 'duplicate':
+			print(style.info(f"{result['origin']}: listed more than once"))
+		elif result['status'] == 'unresolved':
+			print(style.error(f"{result['origin']}: does not respond to telegram API, check the name inserted"))
+		elif result['status'] == 'flood_wait':
+			print(style.error(f"{result['origin']}: gave up after {FLOOD_WAIT_RETRIES + 1} FloodWaits, retry it later"))
+		else:
+			print(style.error(f"{result['origin']}: critical error while inserting it"))
+
+	statuses = [result['status'] for result in report]
+	print(style.sysinfo(', '.join(f"{statuses.count(status)} {status}" for status in ('added', 'exists', 'duplicate', 'unresolved', 'flood_wait', 'error'))))
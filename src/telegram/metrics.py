@@ -0,0 +1,153 @@
+import functools, logging, os, time
+
+logging = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a fast db query to a big download or a node analysis
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+
+HELP = {
+	'tgscraper_db_seconds': 'Duration of the db.py queries',
+	'tgscraper_channel_info_seconds': 'Duration of get_channel_info (get_entity + GetFullChannelRequest)',
+	'tgscraper_message_page_seconds': 'Duration of the page fetches of iter_messages',
+	'tgscraper_download_seconds': 'Duration of the completed transfers',
+	'tgscraper_download_bytes_total': 'Bytes downloaded from telegram',
+	'tgscraper_analysis_seconds': 'Duration of the halAnalyzeDBs node processes',
+	'tgscraper_floodwait_total': 'FloodWaits received',
+	'tgscraper_floodwait_seconds_total': 'Seconds asked by the FloodWaits',
+}
+
+# Off by default: every hook checks this flag first and falls back to the plain call
+_enabled = False
+_started = time.time()
+_counters = {} # (name, labels) -> value
+_histograms = {} # (name, labels) -> [bucket counts, sum, count]
+
+
+def enable():
+	global _enabled, _started
+	_enabled = True
+	_started = time.time()
+
+def is_enabled():
+	return _enabled
+
+
+def inc(name, value=1, **labels):
+	if not _enabled:
+		return
+	key = (name, tuple(sorted(labels.items())))
+	_counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+	if not _enabled:
+		return
+	key = (name, tuple(sorted(labels.items())))
+	histogram = _histograms.get(key)
+	if histogram == None:
+		histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+	for i, bound in enumerate(BUCKETS):
+		if seconds <= bound:
+			histogram[0][i] += 1
+			break
+	histogram[1] += seconds
+	histogram[2] += 1
+
+
+# Decorator for coroutines, the function name becomes the label
+def timed(name, label='function'):
+	def decorator(func):
+		@functools.wraps(func)
+		async def wrapper(*args, **kwargs):
+			if not _enabled:
+				return await func(*args, **kwargs)
+			start = time.perf_counter()
+			try:
+				return await func(*args, **kwargs)
+			finally:
+				observe(name, time.perf_counter() - start, **{label: func.__name__})
+		return wrapper
+	return decorator
+
+
+# Times the requests of a telethon RequestIter (iter_messages, iter_download...). The messages come
+# from an internal buffer, only the steps that find it empty send a request to telegram
+def pages(request_iter, name):
+	if not _enabled:
+		return request_iter
+	return _timed_pages(request_iter, name)
+
+async def _timed_pages(request_iter, name):
+	while True:
+		buffer = getattr(request_iter, 'buffer', None)
+		fetching = buffer == None or request_iter.index >= len(buffer)
+		start = time.perf_counter()
+		try:
+			item = await request_iter.__anext__()
+		except StopAsyncIteration:
+			return
+		finally:
+			if fetching:
+				observe(name, time.perf_counter() - start)
+		yield item
+
+
+def _format_labels(labels, extra=()):
+	labels = tuple(labels) + tuple(extra)
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def render():
+	lines = []
+	names = sorted({name for name, _ in _counters} | {name for name, _ in _histograms})
+	for name in names:
+		lines.append(f'# HELP {name} {HELP.get(name, name)}')
+		if name.endswith('_total'):
+			lines.append(f'# TYPE {name} counter')
+			for (key_name, labels), value in sorted(_counters.items()):
+				if key_name == name:
+					lines.append(f'{name}{_format_labels(labels)} {value}')
+		else:
+			lines.append(f'# TYPE {name} histogram')
+			for (key_name, labels), (buckets, total, count) in sorted(_histograms.items()):
+				if key_name != name:
+					continue
+				cumulative = 0
+				for bound, bucket in zip(BUCKETS, buckets):
+					cumulative += bucket
+					le = '+Inf' if bound == float('inf') else repr(bound)
+					lines.append(f'{name}_bucket{_format_labels(labels, (("le", le),))} {cumulative}')
+				lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+				lines.append(f'{name}_count{_format_labels(labels)} {count}')
+	return '\n'.join(lines) + '\n'
+
+# Prometheus textfile (node_exporter textfile collector), written atomically so it is never read half done
+def write_textfile(file_path):
+	if not _enabled or not file_path:
+		return
+	try:
+		with open(file_path + '.tmp', 'w') as f:
+			f.write(render())
+		os.replace(file_path + '.tmp', file_path)
+	except OSError as e:
+		logging.error('Unable to write the metrics to %s: %s', file_path, e)
+
+
+def log_summary():
+	if not _enabled:
+		return
+
+	logging.info('Run summary after %.0f seconds:', time.time() - _started)
+	# Slowest first, that's where the run went
+	for (name, labels), (_, total, count) in sorted(_histograms.items(), key=lambda item: item[1][1], reverse=True):
+		label = ' '.join(str(value) for _, value in labels)
+		logging.info('  %s %s: %s calls, %.2f seconds total, %.3f avg', name, label, count, total, total / count)
+
+	download_bytes = sum(value for (name, _), value in _counters.items() if name == 'tgscraper_download_bytes_total')
+	download_seconds = sum(total for (name, _), (_, total, _) in _histograms.items() if name == 'tgscraper_download_seconds')
+	if download_seconds:
+		logging.info('  downloads: %s bytes, %.0f bytes/sec per transfer', download_bytes, download_bytes / download_seconds)
+
+	for (name, labels), value in sorted(_counters.items()):
+		if name != 'tgscraper_download_bytes_total':
+			logging.info('  %s%s: %s', name, _format_labels(labels), value)
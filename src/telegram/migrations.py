@@ -0,0 +1,143 @@
+import asyncio
+
+from style import style
+from db import create_async_pool
+
+# Versioned schema changes for the databases created before the telegram tables/columns were added
+# to createDB.sql. Every statement is idempotent, so running them on a fresh database is harmless.
+# Append only: a version, once released, must never change.
+MIGRATIONS = [
+	(1, 'analysis queue', [
+		'''CREATE TABLE IF NOT EXISTS analysis_queue(
+			_id_analysis_queue serial PRIMARY KEY,
+			file_path varchar(1024) NOT NULL,
+			status int NOT NULL DEFAULT 0,
+			attempts int NOT NULL DEFAULT 0,
+			enqueued_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			updated_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			_id_source int NOT NULL,
+			CONSTRAINT _fk_source FOREIGN KEY(_id_source) REFERENCES source(_id_source) ON DELETE RESTRICT ON UPDATE CASCADE
+		)'''
+	]),
+	(2, 'content addressed store', [
+		'''CREATE TABLE IF NOT EXISTS content_index(
+			_id_content serial PRIMARY KEY,
+			sha256 char(64) NOT NULL UNIQUE,
+			size bigint NOT NULL,
+			file_path varchar(1024) NOT NULL,
+			first_seen_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+		)''',
+		'''CREATE TABLE IF NOT EXISTS source_content(
+			_id_source int PRIMARY KEY,
+			document_id bigint,
+			size bigint,
+			_id_content int NOT NULL,
+			CONSTRAINT _fk_source FOREIGN KEY(_id_source) REFERENCES source(_id_source) ON DELETE RESTRICT ON UPDATE CASCADE,
+			CONSTRAINT _fk_content_index FOREIGN KEY(_id_content) REFERENCES content_index(_id_content) ON DELETE RESTRICT ON UPDATE CASCADE
+		)''',
+		'CREATE INDEX IF NOT EXISTS source_content_document_idx ON source_content(document_id, size)'
+	]),
+	(3, 'origin entity cache', [
+		'''CREATE TABLE IF NOT EXISTS origin_entity(
+			_id_origin int PRIMARY KEY,
+			channel_id bigint NOT NULL,
+			access_hash bigint NOT NULL,
+			resolved_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			metadata jsonb,
+			CONSTRAINT _fk_origin FOREIGN KEY(_id_origin) REFERENCES origin(_id_origin) ON DELETE CASCADE ON UPDATE CASCADE
+		)'''
+	]),
+	(4, 'origin_history parsed_infos', [
+		'ALTER TABLE origin_history ADD COLUMN IF NOT EXISTS parsed_infos jsonb'
+	]),
+	(5, 'origin and dedupe lookup indexes', [
+		'CREATE INDEX IF NOT EXISTS origin_category_domain_idx ON origin(category, domain)',
+		'CREATE INDEX IF NOT EXISTS origin_history_origin_time_idx ON origin_history(_id_origin, updated_time DESC)',
+		'CREATE INDEX IF NOT EXISTS source_origin_idx ON source(_id_origin)',
+		'CREATE INDEX IF NOT EXISTS source_telegram_source_idx ON source_telegram(_id_source, _id_source_telegram)',
+		'CREATE INDEX IF NOT EXISTS analysis_queue_source_idx ON analysis_queue(_id_source)',
+		'CREATE INDEX IF NOT EXISTS analysis_queue_pending_idx ON analysis_queue(_id_analysis_queue) WHERE status IN (0, 1)'
+	]),
+	(6, 'origin entity cache per account', [
+		"ALTER TABLE origin_entity ADD COLUMN IF NOT EXISTS account varchar(32) NOT NULL DEFAULT ''",
+		'ALTER TABLE origin_entity DROP CONSTRAINT IF EXISTS origin_entity_pkey',
+		'ALTER TABLE origin_entity ADD PRIMARY KEY (_id_origin, account)'
+	]),
+	(7, 'adaptive origin schedule', [
+		'''CREATE TABLE IF NOT EXISTS origin_schedule(
+			_id_origin int PRIMARY KEY,
+			next_due timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			interval_seconds int NOT NULL,
+			activity real NOT NULL DEFAULT 0,
+			new_messages int NOT NULL DEFAULT 0,
+			new_files int NOT NULL DEFAULT 0,
+			checked_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			CONSTRAINT _fk_origin FOREIGN KEY(_id_origin) REFERENCES origin(_id_origin) ON DELETE CASCADE ON UPDATE CASCADE
+		)''',
+		'CREATE INDEX IF NOT EXISTS origin_schedule_due_idx ON origin_schedule(next_due)'
+	]),
+	(8, 'message search', [
+		'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+		# Rewrites the whole table once, the inserts keep it up to date from then on
+		"ALTER TABLE source_telegram ADD COLUMN IF NOT EXISTS message_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', message_text)) STORED",
+		'CREATE INDEX IF NOT EXISTS source_telegram_tsv_idx ON source_telegram USING gin(message_tsv)',
+		'CREATE INDEX IF NOT EXISTS source_telegram_trgm_idx ON source_telegram USING gin(message_text gin_trgm_ops)'
+	]),
+	(9, 'backfill segments', [
+		'''CREATE TABLE IF NOT EXISTS backfill_segment(
+			_id_origin int,
+			min_id int,
+			max_id int NOT NULL,
+			last_checked int NOT NULL,
+			updated_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			CONSTRAINT _fk_origin FOREIGN KEY(_id_origin) REFERENCES origin(_id_origin) ON DELETE CASCADE ON UPDATE CASCADE,
+			PRIMARY KEY (_id_origin, min_id)
+		)'''
+	]),
+]
+
+
+async def run_migrations(pool):
+	try:
+		async with pool.acquire() as conn:
+			await conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations(
+									version int PRIMARY KEY,
+									description varchar(255),
+									applied_time timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+								)''')
+
+			applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+
+			for version, description, statements in MIGRATIONS:
+				if version in applied:
+					continue
+
+				# One transaction per version, a failure leaves the database at the previous one
+				async with conn.transaction():
+					for statement in statements:
+						await conn.execute(statement)
+					await conn.execute('INSERT INTO schema_migrations (version, description) VALUES ($1, $2)', version, description)
+
+				print(style.success(f"Migration {version} applied: {description}"))
+
+			return max([version for version, _, _ in MIGRATIONS])
+
+	except Exception as e:
+		print(style.error(f"Unexpected error while migrating the database: {e}"))
+		return None
+
+
+async def main():
+	pool = await create_async_pool()
+	if (not pool):
+		print(style.error("Connection to the DB failed"))
+		return -1
+
+	version = await run_migrations(pool)
+	if version:
+		print(style.success(f"Database schema up to date at version {version}"))
+	await pool.close()
+
+
+if __name__ == "__main__":
+	asyncio.get_event_loop().run_until_complete(main())
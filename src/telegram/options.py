@@ -5,6 +5,17 @@ def initialize_options():
     parser = argparse.ArgumentParser("Scrape and scrape and scrape")
 
     parser.add_argument('-ao', '--AddOrigin', help = "Add a new origin to track", metavar='')
+    parser.add_argument('-io', '--ImportOrigins', help = "Add every origin listed in a file, one per line. - reads them from stdin", metavar='')
+    parser.add_argument('-rp', '--Report', help = "With --ImportOrigins, save the result of every origin in this json file", metavar='')
+    parser.add_argument('-m', '--Migrate', help = "Apply the pending schema migrations and indexes to the database", action='store_true')
+    parser.add_argument('-s', '--Search', help = "Search the scraped messages, best matches first", metavar='')
+    parser.add_argument('-sm', '--SearchMode', help = "With --Search, text for the keywords (websearch syntax) or substring for any part of a word", choices=['text', 'substring'], default='text')
+    parser.add_argument('-so', '--SearchOrigin', help = "With --Search, only the messages of this origin", metavar='')
+    parser.add_argument('-ss', '--Since', help = "With --Search, only the messages published from this ISO date", metavar='')
+    parser.add_argument('-su', '--Until', help = "With --Search, only the messages published before this ISO date", metavar='')
+    parser.add_argument('-sl', '--Limit', help = "With --Search, messages per page", type=int, default=20, metavar='')
+    parser.add_argument('-sc', '--Cursor', help = "With --Search, the page after the one that printed this cursor", metavar='')
+    parser.add_argument('-d', '--Daemon', help = "Keep the scraper running and ingest the new files as soon as they are posted", action='store_true')
 
     # Read arguments from command line
     argv = parser.parse_args()
@@ -0,0 +1,217 @@
+import asyncio, logging, os, struct, zipfile
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import DocumentAttributeFilename
+
+import metrics
+
+logging = logging.getLogger(__name__)
+
+# Formats that are never a text dump, whatever the extension says
+BINARY_SIGNATURES = {
+	b'PK\x03\x04': 'zip',
+	b'Rar!\x1a\x07': 'rar',
+	b'7z\xbc\xaf\x27\x1c': '7z',
+	b'\x1f\x8b': 'gzip',
+	b'%PDF': 'pdf',
+	b'MZ': 'exe',
+	b'\x7fELF': 'elf',
+	b'\x89PNG': 'png',
+	b'\xff\xd8\xff': 'jpg',
+}
+TEXT_FILETYPES = ('csv', 'tsv', 'txt', 'sql', 'json', 'xml', 'log')
+DELIMITERS = (',', ';', '\t', '|', ':') # : for the email:password combo lists
+ARCHIVE_FILETYPES = ('zip',) # Only zip, the rar listing needs the whole rar format
+SKIPPED_MIME_TYPES = ('image/', 'video/', 'audio/')
+ZIP_TAIL_BYTES = 64*1024 # End of central directory + the listing of most archives
+READ_ATTEMPTS = 3 # Then the file is downloaded unchecked
+
+
+def document_file_name(document):
+	# Usually the first attribute, not always: the video/audio/sticker ones can come before it
+	for attribute in document.attributes:
+		if isinstance(attribute, DocumentAttributeFilename):
+			return attribute.file_name
+	return None
+
+def file_extension(file_name):
+	return file_name.lower().rsplit('.', 1)[-1] if '.' in file_name else ''
+
+# Every extension worth a look during the scan, the archives are judged on their listing
+def candidate_filetypes(supported_filetypes, archives=False):
+	if archives:
+		return supported_filetypes + [ext for ext in ARCHIVE_FILETYPES if ext not in supported_filetypes]
+	return supported_filetypes
+
+
+def sniff_binary(header):
+	for signature, name in BINARY_SIGNATURES.items():
+		if header.startswith(signature):
+			return name
+	return None
+
+# Only the NUL bytes are hard evidence, a dump in some old codepage is still a dump
+def looks_like_text(header):
+	return b'\x00' not in header
+
+# Same number of fields on the first lines for one of the usual delimiters, or a single column
+def looks_like_delimited(header):
+	lines = header.decode('utf-8', errors='replace').splitlines()[:-1] # The last one is probably cut
+	lines = [line for line in lines if line.strip()][:10]
+	if len(lines) < 2:
+		return True # Too little to judge, a one line sample is not a reason to skip
+
+	for delimiter in DELIMITERS:
+		counts = [line.count(delimiter) for line in lines]
+		if sum(count == counts[0] for count in counts) >= 0.8 * len(counts):
+			return True
+	return False
+
+# File names in the central directory of a zip, from its last bytes. None when the directory is not all there
+def zip_listing(tail):
+	end = tail.rfind(b'PK\x05\x06')
+	if end < 0 or len(tail) - end < 22:
+		return None
+
+	entries, directory_size = struct.unpack('<10xHI', tail[end:end + 16])
+	start = end - directory_size
+	if start < 0:
+		return None
+
+	names = []
+	position = start
+	for _ in range(entries):
+		if tail[position:position + 4] != b'PK\x01\x02':
+			return None
+		name_length, extra_length, comment_length = struct.unpack('<HHH', tail[position + 28:position + 34])
+		names.append(tail[position + 46:position + 46 + name_length].decode('utf-8', errors='replace'))
+		position += 46 + name_length + extra_length + comment_length
+	return names
+
+def is_archive(file_name, supported_filetypes):
+	extension = file_extension(file_name)
+	return extension in ARCHIVE_FILETYPES and extension not in supported_filetypes
+
+# The analyzer only reads the supported files, not the archives: the supported members are extracted
+# in <archive>.d/ and their paths returned. Blocking, run it in a thread
+def extract_supported(archive_path, supported_filetypes):
+	target_directory = archive_path + '.d'
+	extracted = []
+	try:
+		with zipfile.ZipFile(archive_path) as archive:
+			for index, member in enumerate(archive.infolist()):
+				if member.is_dir() or file_extension(member.filename) not in supported_filetypes:
+					continue
+				# Only the base name, a member named ../../something stays in the directory
+				file_path = os.path.join(target_directory, f'{index}_{os.path.basename(member.filename)}')
+				os.makedirs(target_directory, exist_ok=True)
+				with archive.open(member) as source, open(file_path, 'wb') as target:
+					while chunk := source.read(1024*1024):
+						target.write(chunk)
+				extracted.append(file_path)
+	except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e: # Broken, encrypted, unsupported compression
+		logging.error('Unable to extract %s: %s', archive_path, e)
+	return extracted
+
+
+# Decides on a candidate before the full download, from what is free (attributes, mime type, size) and
+# from the first few KB of the file. Only hard evidence is a skip: the supported extension on an archive
+# or an executable, NUL bytes in a text dump. An odd shape is only logged, a lost leak costs more than a
+# useless download. With archives on, zip files go through when their listing has
+# a supported file in it.
+class PreScreen:
+
+	def __init__(self, client, supported_filetypes, sniff_bytes=4096, min_size=0, max_size=0, archives=False, max_requests=4, floodgate=None):
+		self.client = client
+		self.floodgate = floodgate
+		self._semaphore = asyncio.Semaphore(max(1, max_requests))
+		self.supported_filetypes = [ext.lower() for ext in supported_filetypes]
+		# Telegram wants a power of two between 4KB and 512KB, the offset a multiple of it
+		self.sniff_bytes = min(512*1024, 4096 << max(0, (sniff_bytes // 4096).bit_length() - 1))
+		self.min_size = min_size
+		self.max_size = max_size # 0 means no limit
+		self.archives = archives
+
+	# Messages worth the full download, the others are logged and dropped
+	async def filter(self, messages):
+		results = await asyncio.gather(*[self.check(message.media.document) for message in messages])
+		accepted = []
+		for message, (keep, reason) in zip(messages, results):
+			if keep:
+				accepted.append(message)
+			else:
+				logging.info('Skipping %s of message %s: %s', document_file_name(message.media.document), message.id, reason)
+		return accepted
+
+	# (download it, reason)
+	async def check(self, document):
+		async with self._semaphore:
+			accepted, reason = await self._check(document)
+		metrics.inc('tgscraper_prescreen_total', reason=reason)
+		return accepted, reason
+
+	async def _check(self, document):
+		file_name = document_file_name(document)
+		if not file_name:
+			return False, 'no_file_name'
+
+		if document.mime_type and document.mime_type.startswith(SKIPPED_MIME_TYPES):
+			return False, 'mime_type'
+
+		if document.size < self.min_size:
+			return False, 'too_small'
+		if self.max_size and document.size > self.max_size:
+			return False, 'too_big'
+
+		extension = file_extension(file_name)
+
+		try:
+			if is_archive(file_name, self.supported_filetypes):
+				return await self._check_archive(document)
+
+			header = await self._read(document, 0, self.sniff_bytes, 1)
+		except Exception as e:
+			# Better a useless download than a lost leak
+			logging.warning('Unable to pre-screen %s, downloading it anyway: %s', file_name, e)
+			return True, 'unchecked'
+
+		binary = sniff_binary(header)
+		if extension in TEXT_FILETYPES:
+			if binary:
+				return False, 'binary_' + binary
+			if not looks_like_text(header):
+				return False, 'not_text'
+			if extension in ('csv', 'tsv') and not looks_like_delimited(header):
+				logging.info('%s does not look delimited, downloading it anyway', file_name)
+				return True, 'not_delimited'
+
+		return True, 'accepted'
+
+	async def _check_archive(self, document):
+		# The last ZIP_TAIL_BYTES at least, from an aligned offset
+		offset = max(0, document.size - ZIP_TAIL_BYTES) // ZIP_TAIL_BYTES * ZIP_TAIL_BYTES
+		names = zip_listing(await self._read(document, offset, ZIP_TAIL_BYTES, 2))
+		if names == None:
+			return True, 'unchecked' # Directory too big for the tail, or not a zip after all
+
+		if any(file_extension(name) in self.supported_filetypes for name in names):
+			return True, 'archive'
+		return False, 'archive_unsupported'
+
+	# A FloodWait pauses the client like the downloads do, it must not abort the scan of the whole origin
+	async def _read(self, document, offset, request_size, requests):
+		for attempt in range(READ_ATTEMPTS):
+			if self.floodgate:
+				await self.floodgate.wait()
+			try:
+				data = b''
+				async for chunk in self.client.iter_download(document, offset=offset, request_size=request_size, limit=requests):
+					data += chunk
+				return data
+			except FloodWaitError as e:
+				if attempt == READ_ATTEMPTS - 1:
+					raise
+				if self.floodgate:
+					self.floodgate.trip(e.seconds)
+				else:
+					await asyncio.sleep(e.seconds)
@@ -0,0 +1,60 @@
+import logging
+
+from db import selectOrigins, selectDueOrigins, upsertOriginSchedule
+
+logging = logging.getLogger(__name__)
+
+
+# Decides when every origin gets checked again, from what the last checks found. A channel that posts
+# new files is checked sooner and sooner down to min_interval, a quiet one is backed off exponentially
+# up to max_interval, a dead one waits min_interval * 2^is_dead_score. New origins are due at once.
+class Scheduler:
+
+	def __init__(self, pool, min_interval, max_interval, decay=0.7, enabled=True):
+		self.pool = pool
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.decay = decay # Weight of the past in the activity average
+		self.enabled = enabled
+
+	# Disabled: every origin, as before
+	async def due_origins(self):
+		if not self.enabled:
+			return await selectOrigins(pool=self.pool)
+		return await selectDueOrigins(self.pool)
+
+	def next_interval(self, origin, new_messages, new_files, is_dead_score):
+		interval = origin.get('interval_seconds') or self.min_interval
+
+		if is_dead_score:
+			interval = self.min_interval * 2 ** min(is_dead_score, 32)
+		elif new_files:
+			interval = interval / 2
+		elif not new_messages:
+			interval = interval * 2
+		# New messages but no files: the channel is alive, keep the pace
+
+		return int(min(self.max_interval, max(self.min_interval, interval)))
+
+	# stats is what download_supported_files found, None when the channel did not respond
+	async def record(self, origin, stats, is_dead_score=0):
+		if not self.enabled:
+			return None
+
+		new_messages = stats['messages'] if stats else 0
+		new_files = stats['files'] if stats else 0
+		activity = self.decay * (origin.get('activity') or 0) + (1 - self.decay) * new_files
+		interval = self.next_interval(origin, new_messages, new_files, is_dead_score)
+
+		next_due = await upsertOriginSchedule(self.pool, {
+			'_id_origin': origin['_id_origin'],
+			'interval_seconds': interval,
+			'activity': activity,
+			'new_messages': new_messages,
+			'new_files': new_files
+		})
+		if next_due:
+			logging.info('Origin %s - %s: %s new messages, %s new files, next check in %s seconds', origin['_id_origin'], origin['domain'], new_messages, new_files, interval)
+		else:
+			logging.error('Error while scheduling the next check of origin %s - %s', origin['_id_origin'], origin['domain'])
+		return next_due
@@ -0,0 +1,77 @@
+import base64, json
+from datetime import datetime
+
+import pytz
+
+from style import style
+from db import searchMessages, selectOriginByDomain
+from importer import parse_domain
+
+PREVIEW_CHARS = 200
+
+
+# The position after the last row of a page, opaque for whoever pages through the results
+def encode_cursor(row):
+	return base64.urlsafe_b64encode(json.dumps([row['rank'], row['_id_source'], row['_id_source_telegram']]).encode()).decode()
+
+def decode_cursor(cursor):
+	try:
+		rank, _id_source, _id_source_telegram = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+		return {'rank': float(rank), '_id_source': int(_id_source), '_id_source_telegram': int(_id_source_telegram)}
+	except (ValueError, TypeError):
+		return None
+
+# ISO date or date and time, UTC when the zone is missing
+def parse_time(value):
+	if not value:
+		return None
+	time = datetime.fromisoformat(value)
+	return time if time.tzinfo else pytz.UTC.localize(time)
+
+
+# One page of messages for the query: (rows, cursor of the next page or None when this was the last one)
+async def search_messages(pool, query, mode='text', origin=None, since=None, until=None, limit=20, cursor=None):
+	after = None
+	if cursor:
+		after = decode_cursor(cursor)
+		if not after:
+			print(style.error("Invalid search cursor"))
+			return None, None
+
+	try:
+		since, until = parse_time(since), parse_time(until)
+	except ValueError:
+		print(style.error("Invalid --Since or --Until, expected an ISO date like 2024-01-31 or 2024-01-31T12:00:00"))
+		return None, None
+
+	_id_origin = None
+	if origin:
+		origins = await selectOriginByDomain(pool, parse_domain(origin))
+		if not origins:
+			print(style.error(f"Origin {origin} not found in the db"))
+			return None, None
+		_id_origin = origins[0]['_id_origin']
+
+	# One row more than asked tells if there is a next page
+	rows = await searchMessages(pool, query, mode, _id_origin, since, until, after, limit + 1)
+	if rows == None:
+		return None, None
+
+	if len(rows) > limit:
+		rows = rows[:limit]
+		return rows, encode_cursor(rows[-1])
+	return rows, None
+
+
+def print_results(rows, cursor):
+	for row in rows:
+		text = ' '.join(row['message_text'].split())
+		if len(text) > PREVIEW_CHARS:
+			text = text[:PREVIEW_CHARS] + '...'
+		print(style.success(f"{row['domain']} #{row['_id_source_telegram']} (source ID: {row['_id_source']}, {row['published_time']}, rank {row['rank']:.4f})"))
+		print(style.data(text))
+
+	if not rows:
+		print(style.info("No messages found"))
+	elif cursor:
+		print(style.sysinfo(f"Next page: --Cursor {cursor}"))
@@ -1,15 +1,43 @@
 
 from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.errors import FloodWaitError
+import json
 
+from metrics import timed
+from accounts import BAN_ERRORS
+
+# id + access_hash only, without the GetFullChannelRequest
+async def get_channel_entity(client, channel_username):
+	try:
+		return await client.get_entity(channel_username)
+
+	except (FloodWaitError, *BAN_ERRORS):
+		raise
+	except Exception as e:
+		return None
+
+@timed('tgscraper_channel_info_seconds')
 async def get_channel_info(client, channel_username):
 	try:
 		entity = await client.get_entity(channel_username)
 		if entity:
 			return await client(GetFullChannelRequest(channel=entity)) # type: ignore
 
+	except (FloodWaitError, *BAN_ERRORS):
+		raise # Not a dead channel, the caller has to back off or change account and retry
 	except Exception as e:
 		return None
 	
+# Cheap liveness check on an already resolved channel (GetChannelsRequest instead of a full request)
+async def is_channel_alive(client, peer):
+	try:
+		return bool(await client.get_entity(peer))
+
+	except (FloodWaitError, *BAN_ERRORS):
+		raise
+	except Exception as e:
+		return False
+
 async def parse_channel_info(raw_data):
 	try:
 		return {
@@ -25,4 +53,15 @@ async def parse_channel_info(raw_data):
 		}
 
 	except Exception as e:
-		return None
\ No newline at end of file
+		return None
+
+# Compares the tracked fields of a new parse_channel_info with the parsed_infos of the latest origin_history
+def history_changed(latest_parsed_infos, parsed_infos, tracked_fields):
+	if not latest_parsed_infos:
+		return True
+
+	if isinstance(latest_parsed_infos, str):
+		latest_parsed_infos = json.loads(latest_parsed_infos)
+
+	parsed_infos = json.loads(json.dumps(parsed_infos, default=str)) # Same shape of what comes back from the jsonb
+	return any(latest_parsed_infos.get(field) != parsed_infos.get(field) for field in tracked_fields)
\ No newline at end of file
@@ -0,0 +1,232 @@
+import asyncio, inspect, json, logging, sys, time
+
+import metrics
+from tgscraper import initialize_components, wait_transfers, scrape_origins, ACCOUNTS, METRICS_TEXTFILE
+from client import connect_clients
+from db import create_async_pool, selectOrigins
+from importer import import_origins
+
+logging = logging.getLogger(__name__)
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+class ServiceError(Exception):
+
+	def __init__(self, code, message):
+		super().__init__(message)
+		self.code = code
+
+
+# Long lived scraper for walle.ts: the clients, the pool and the download/analysis workers stay up
+# between the commands instead of paying the imports, the login and a new pool at every spawn.
+# JSON-RPC 2.0 over stdio, one message per line. stdout carries only the protocol, the logs go to stderr.
+# The sessions must be already logged in (tginsert.py or tgscraper.py once), stdin can't ask for the code.
+class Service:
+
+	def __init__(self, protocol_out):
+		self.protocol_out = protocol_out
+		self.started = time.time()
+		self.scrape_task = None
+		self.last_run = None
+		self.stopping = asyncio.Event()
+		self.methods = {
+			'add_origin': self.add_origin,
+			'scrape_now': self.scrape_now,
+			'status': self.status,
+			'list_origins': self.list_origins,
+			'shutdown': self.shutdown,
+		}
+
+	async def initialize(self):
+		self.clients = await connect_clients(ACCOUNTS)
+		if not self.clients:
+			raise ServiceError(SERVER_ERROR, 'Telegram client not available, log in once with tginsert.py or tgscraper.py')
+
+		self.pool = await create_async_pool()
+		if not self.pool:
+			raise ServiceError(SERVER_ERROR, 'Connection to the DB failed')
+
+		self.analysis_queue, self.account_pool, self.entity_cache, self.scheduler = await initialize_components(self.pool, self.clients)
+
+	def send(self, message):
+		self.protocol_out.write(json.dumps(message, default=str) + '\n')
+		self.protocol_out.flush()
+
+	def notify(self, method, params):
+		self.send({'jsonrpc': '2.0', 'method': method, 'params': params})
+
+	async def handle(self, line):
+		try:
+			request = json.loads(line)
+		except ValueError as e:
+			return self.send({'jsonrpc': '2.0', 'id': None, 'error': {'code': PARSE_ERROR, 'message': str(e)}})
+
+		request_id = request.get('id') if isinstance(request, dict) else None
+		try:
+			if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+				raise ServiceError(INVALID_REQUEST, 'Not a JSON-RPC request')
+
+			method = self.methods.get(request['method'])
+			if not method:
+				raise ServiceError(METHOD_NOT_FOUND, f"Unknown method {request['method']}")
+
+			params = request.get('params') or {}
+			if not isinstance(params, dict):
+				raise ServiceError(INVALID_PARAMS, 'params must be an object')
+
+			try:
+				inspect.signature(method).bind(**params)
+			except TypeError as e:
+				raise ServiceError(INVALID_PARAMS, str(e))
+
+			result = await method(**params)
+
+			response = {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+		except ServiceError as e:
+			response = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': e.code, 'message': str(e)}}
+		except Exception as e:
+			logging.exception('Unexpected error while handling %s: %s', line.strip(), e)
+			response = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': SERVER_ERROR, 'message': str(e)}}
+
+		if request_id != None: # No answer to the notifications
+			self.send(response)
+
+	async def serve(self, reader):
+		tasks = set()
+		# Every request runs on its own, status answers while a scrape_now is waiting
+		while not self.stopping.is_set():
+			line = await reader.readline()
+			if not line:
+				break # walle went away
+			if not line.strip():
+				continue
+			task = asyncio.create_task(self.handle(line.decode()))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+
+		if tasks:
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+	##############################################################
+	### Methods ##################################################
+
+	async def add_origin(self, origin=None, origins=None):
+		entries = ([origin] if origin else []) + (origins or [])
+		if not entries:
+			raise ServiceError(INVALID_PARAMS, 'origin or origins required')
+
+		accounts = self.account_pool.available()
+		if not accounts:
+			raise ServiceError(SERVER_ERROR, 'No telegram account available')
+		return await import_origins(self.pool, accounts[0].client, [str(entry).strip() for entry in entries])
+
+	# Due origins by default, every origin with all, or only the given ids. wait returns when the scan is done
+	async def scrape_now(self, origin_ids=None, all=False, wait=False):
+		if self.scrape_task and not self.scrape_task.done():
+			raise ServiceError(SERVER_ERROR, 'A scrape is already running')
+
+		if origin_ids or all:
+			telegram_origins = await selectOrigins(pool=self.pool)
+			if telegram_origins != None and origin_ids:
+				telegram_origins = [origin for origin in telegram_origins if origin['_id_origin'] in origin_ids]
+		else:
+			telegram_origins = await self.scheduler.due_origins()
+
+		if telegram_origins == None:
+			raise ServiceError(SERVER_ERROR, 'Error while retrieving the origins from the database')
+
+		self.scrape_task = asyncio.create_task(self._scrape(telegram_origins))
+		if wait:
+			return await asyncio.shield(self.scrape_task)
+		return {'started': len(telegram_origins)}
+
+	async def _scrape(self, telegram_origins):
+		start = time.time()
+		results = await scrape_origins(self.pool, self.account_pool, self.entity_cache, self.scheduler, telegram_origins) if telegram_origins else []
+		metrics.write_textfile(METRICS_TEXTFILE)
+
+		self.last_run = {
+			'started': start,
+			'seconds': round(time.time() - start, 3),
+			'scraped': results.count(True),
+			'failed': results.count(False)
+		}
+		self.notify('scrape_done', self.last_run)
+		return self.last_run
+
+	async def status(self):
+		return {
+			'uptime_seconds': round(time.time() - self.started),
+			'scraping': bool(self.scrape_task and not self.scrape_task.done()),
+			'last_run': self.last_run,
+			'accounts': [account.stats() for account in self.account_pool.accounts],
+			'downloads_pending': sum(account.download_manager.pending() for account in self.account_pool.accounts),
+			'analysis_pending': self.analysis_queue.pending()
+		}
+
+	async def list_origins(self):
+		telegram_origins = await selectOrigins(pool=self.pool)
+		if telegram_origins == None:
+			raise ServiceError(SERVER_ERROR, 'Error while retrieving the origins from the database')
+
+		return [{
+			'_id_origin': origin['_id_origin'],
+			'domain': origin['domain'],
+			'last_checked': origin['last_checked'],
+			'is_dead_score': origin['is_dead_score'],
+			'updated_time': origin['updated_time']
+		} for origin in telegram_origins]
+
+	async def shutdown(self):
+		self.stopping.set()
+		return {'stopping': True}
+
+	##############################################################
+
+	async def close(self):
+		if self.scrape_task:
+			await asyncio.gather(self.scrape_task, return_exceptions=True)
+		await wait_transfers(self.account_pool, self.analysis_queue)
+		for _, client in self.clients:
+			await client.disconnect()
+		await self.pool.close()
+
+
+async def main():
+	# Whatever prints on its own (style messages of db.py and friends) must not end up in the protocol
+	protocol_out = sys.stdout
+	sys.stdout = sys.stderr
+
+	service = Service(protocol_out)
+	try:
+		await service.initialize()
+	except ServiceError as e:
+		service.notify('failed', {'code': e.code, 'message': str(e)})
+		return 1
+
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader(limit=16*1024*1024)
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+	service.notify('ready', {'accounts': [phone_number for phone_number, _ in service.clients]})
+	logging.info('Service ready')
+
+	# Stops on shutdown or when stdin is closed
+	serving = asyncio.create_task(service.serve(reader))
+	stopping = asyncio.create_task(service.stopping.wait())
+	await asyncio.wait([serving, stopping], return_when=asyncio.FIRST_COMPLETED)
+	serving.cancel()
+
+	logging.info('Service stopping, waiting for the running transfers')
+	await service.close()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(asyncio.run(main()))
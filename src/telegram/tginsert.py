@@ -4,9 +4,13 @@ import asyncio
 from db import insertOrigin, create_async_pool, selectOriginByDomain, insertOriginHistory
 
 from telethon.sync import TelegramClient
-import os, re
+from telethon.errors import FloodWaitError
+import os, json
 
-from sentinel import get_channel_info
+from sentinel import get_channel_info, parse_channel_info
+from migrations import run_migrations
+from importer import parse_domain, read_origins, import_origins, print_report
+from search import search_messages, print_results
 
 
 api_id = os.getenv("TELEGRAM_API_ID")
@@ -19,24 +23,76 @@ ROOT_PATH = os.getenv('ROOT_PATH')
 if( phone_number and api_id and api_hash):
 	client = TelegramClient(phone_number, int(api_id), api_hash)
 
+async def start_client():
+	if(client and phone_number):
+		await client.start(phone_number)   # type: ignore
+		me = await client.get_me()
+		if(not me):
+			print(style.error("Connection to the client failed"))
+			return False
+		print(style.info(f"Client online with user {me.username}")) # type: ignore
+		return True
+	else:
+		print(style.error("Connection to the client failed"))
+		return False
+
 async def main():
 
 	print(style.sysinfo("Welcome to the telegram insert! Setting up so you're ready to go"))
 
 	argv = initialize_options()
 
+	if argv.Migrate:
+		pool = await create_async_pool()
+		if (not pool):
+			print(style.error("Connection to the DB failed"))
+			return -1
+
+		version = await run_migrations(pool)
+		if version:
+			print(style.success(f"Database schema up to date at version {version}"))
+		return
+
+	if argv.Search:
+		pool = await create_async_pool()
+		if (not pool):
+			print(style.error("Connection to the DB failed"))
+			return -1
+
+		rows, cursor = await search_messages(pool, argv.Search, argv.SearchMode, argv.SearchOrigin, argv.Since, argv.Until, argv.Limit, argv.Cursor)
+		if rows == None:
+			return -1
+		print_results(rows, cursor)
+		return
+
+	if argv.ImportOrigins:
+		entries = read_origins(argv.ImportOrigins) # Before the login, it can ask for the code
+		if not entries:
+			print(style.error("No origins to import"))
+			return -1
+
+		if not await start_client():
+			return -1
+
+		pool = await create_async_pool()
+		if (not pool):
+			print(style.error("Connection to the DB failed"))
+			return -1
+		print(style.info(f"Database connected"))
+
+		report = await import_origins(pool, client, entries)
+		print_report(report)
+
+		if argv.Report:
+			with open(argv.Report, 'w') as f:
+				json.dump(report, f, indent='\t', default=str)
+			print(style.info(f"Report saved in {argv.Report}"))
+		return
+
 	if argv.AddOrigin:
 		##############################################################
 		### Client initialization ####################################
-		if(client and phone_number):
-			await client.start(phone_number)   # type: ignore
-			me = await client.get_me()
-			if(not me):
-				print(style.error("Connection to the client failed"))
-				return -1
-			print(style.info(f"Client online with user {me.username}")) # type: ignore
-		else:
-			print(style.error("Connection to the client failed"))
+		if not await start_client():
 			return -1
 			
 		##############################################################   //TODO Questa andrebbe cambiata da pool a conn, stesso adattamento alle richieste poi
@@ -50,17 +106,19 @@ async def main():
 		
 		##############################################################
 
-		if re.match(r"^-[0-9]{13}$", argv.AddOrigin):
-			domain = int(argv.AddOrigin)
-		else:
-			domain = argv.AddOrigin
+		domain = parse_domain(argv.AddOrigin)
 
 		print(style.sysinfo(f"Adding the requested new domain: {domain}"))
 
 		rows = await selectOriginByDomain(pool=pool, domain=domain)
 
 		if rows != None and len(rows) == 0:
-			additional_infos = await get_channel_info(client, domain)
+			try:
+				additional_infos = await get_channel_info(client, domain)
+			except FloodWaitError as e:
+				print(style.error(f'FloodWait from telegram while resolving {domain}, wait {e.seconds} seconds before trying again'))
+				return -1
+
 			if(additional_infos):
 				origin = {
 					'domain': domain,
@@ -74,11 +132,11 @@ async def main():
 					print(style.success(f'The origin {domain} has been added to the database. Assigned ID: {_id_origin}'))
 
 					origin_history = {
-						'additional_infos': str(additional_infos),
+						'parsed_infos': await parse_channel_info(additional_infos),
 						'_id_origin': _id_origin
 					}
 
-					_id_origin_history = await insertOriginHistory(pool=pool, origin_history=origin_history) #TODO servirebbe un pezzo di parser che non prenda e metta dentro tutte le info come history ma selezioni un po' la roba importante
+					_id_origin_history = await insertOriginHistory(pool=pool, origin_history=origin_history)
 					if(_id_origin_history):
 						print(style.success(f'The origin history associated to {domain} has been added to the database. Assigned ID: {_id_origin_history}'))
 					else:
@@ -90,7 +148,7 @@ async def main():
 				print(style.error(f'The origin {domain} does not respond to telegram API, check the name inserted'))
 		else:
 			print(style.error(f'Origin {domain} already present in the db'))
-	
+
 
 if __name__ == "__main__":
 	asyncio.get_event_loop().run_until_complete(main())
\ No newline at end of file
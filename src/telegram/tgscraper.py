@@ -1,13 +1,28 @@
 from datetime import datetime, timedelta
-import asyncio, subprocess, logging, pytz, os, json, sys
+import asyncio, logging, pytz, os, json, sys, time
+from collections import Counter
 
-from telethon.tl.types import DocumentAttributeFilename
-import re
+from telethon.tl.types import InputMessagesFilterDocument
+from telethon.errors import FloodWaitError
+from telethon import events
 from dotenv import load_dotenv
 
-from client import initialize_client
-from db import create_async_pool, selectOrigins, insertOriginHistory, insertSource, selectSourceTegramByDomainAndMessage, updateOriginDeadScore, updateOriginLastChecked
-from sentinel import get_channel_info, parse_channel_info
+from options import initialize_options
+from client import initialize_clients
+from db import create_async_pool, selectOrigins, insertOriginHistory, updateOriginHistoryTime, insertSource, insertSources, selectSourceTelegramIdsByDomain, updateOriginDeadScore, selectBackfillSegments, insertBackfillSegments, completeBackfill, selectOriginLastChecked
+from sentinel import parse_channel_info, history_changed
+from floodgate import FloodGate
+from analyzer import AnalysisQueue
+from downloader import DownloadManager, Bandwidth
+from contentstore import ContentStore
+from checkpoint import Checkpoint
+from backfill import SegmentCheckpoint, plan_segments, segment_done
+from entitycache import EntityCache
+from importer import parse_domain
+from accounts import Account, AccountPool, BAN_ERRORS
+from scheduler import Scheduler
+from prescreen import PreScreen, document_file_name, candidate_filetypes
+import metrics
 
 ##############################################################
 ### config.json and env SETUP ################################
@@ -21,10 +36,48 @@ with open(os.path.join(os.path.dirname(__file__), '../../config.json')) as f:
 	LOG_LEVEL = config["Telegram"]["LOG_LEVEL"]
 	SUPPORTED_FILETYPES = config["General"]["SUPPORTED_FILETYPES"]
 	ROOT_PATH = config["General"]["ROOT_PATH"]
+	MAX_CONCURRENT_ORIGINS = config["Telegram"].get("MAX_CONCURRENT_ORIGINS", 1) # 1 is the old one-origin-at-a-time behaviour
+	FLOOD_WAIT_RETRIES = config["Telegram"].get("FLOOD_WAIT_RETRIES", 3)
+	DEDUPE_WINDOW = config["Telegram"].get("DEDUPE_WINDOW", 100) # Supported messages checked against the db with a single query
+	BULK_INSERT = config["Telegram"].get("BULK_INSERT", True) # Buffered mode: every window is inserted in a single transaction
+	INSERT_FLUSH_SECONDS = config["Telegram"].get("INSERT_FLUSH_SECONDS", 30) # Max time a supported message waits in the buffer
+	ANALYSIS_WORKERS = config["Telegram"].get("ANALYSIS_WORKERS", 2) # node analyzers running at the same time
+	ANALYSIS_MAX_ATTEMPTS = config["Telegram"].get("ANALYSIS_MAX_ATTEMPTS", 3)
+	ANALYSIS_RETRY_SECONDS = config["Telegram"].get("ANALYSIS_RETRY_SECONDS", 60) # Wait before retrying a failed analysis, doubled at every attempt
+	MAX_CONCURRENT_DOWNLOADS = config["Telegram"].get("MAX_CONCURRENT_DOWNLOADS", 3)
+	DOWNLOAD_CHUNK_SIZE = config["Telegram"].get("DOWNLOAD_CHUNK_SIZE", 512*1024) # Multiple of 4096, 512KB max
+	DOWNLOAD_RETRIES = config["Telegram"].get("DOWNLOAD_RETRIES", 3)
+	MAX_DOWNLOAD_BYTES_PER_SECOND = config["Telegram"].get("MAX_DOWNLOAD_BYTES_PER_SECOND", 0) # Global cap, 0 to disable
+	FILTERED_SCAN = config["Telegram"].get("FILTERED_SCAN", True) # Ask telegram for documents only
+	FILTERED_SCAN_SEARCH = config["Telegram"].get("FILTERED_SCAN_SEARCH", False) # Also search the extensions server side, one pass per extension
+	DAEMON_SWEEP_SECONDS = config["Telegram"].get("DAEMON_SWEEP_SECONDS", 3600) # Daemon mode, catch-up scan of every origin from last_checked
+	CHECKPOINT_MESSAGES = config["Telegram"].get("CHECKPOINT_MESSAGES", 1000) # Save last_checked during long scans every N message ids...
+	CHECKPOINT_SECONDS = config["Telegram"].get("CHECKPOINT_SECONDS", 60) # ...or every T seconds
+	ENTITY_CACHE_TTL = config["Telegram"].get("ENTITY_CACHE_TTL", 604800) # Seconds before a cached channel gets resolved again
+	HISTORY_TRACKED_FIELDS = config["Telegram"].get("HISTORY_TRACKED_FIELDS", ["about", "participants_count", "admins_count", "hidden_prehistory"]) # A new origin_history is written only when one of these changes
+	ACCOUNTS = config["Telegram"].get("ACCOUNTS", []) # Phone numbers of the account pool, empty to use TELEGRAM_PHONE_NUMBER only
+	METRICS = config["Telegram"].get("METRICS", False) # Timings of the db, telegram, downloads and analysis, logged at the end of the run
+	METRICS_TEXTFILE = config["Telegram"].get("METRICS_TEXTFILE", "") # Prometheus textfile with the same metrics, empty to disable
+	SCHEDULER = config["Telegram"].get("SCHEDULER", True) # Check only the origins due, false to check every origin at every run
+	SCHEDULE_MIN_INTERVAL = config["Telegram"].get("SCHEDULE_MIN_INTERVAL", 900) # Seconds between two checks of the most active channels...
+	SCHEDULE_MAX_INTERVAL = config["Telegram"].get("SCHEDULE_MAX_INTERVAL", 604800) # ...and of the quiet or dead ones
+	SCHEDULE_ACTIVITY_DECAY = config["Telegram"].get("SCHEDULE_ACTIVITY_DECAY", 0.7) # Weight of the past checks in the activity of an origin
+	PRESCREEN = config["Telegram"].get("PRESCREEN", True) # Look at the first KB of the new files before downloading them
+	PRESCREEN_BYTES = config["Telegram"].get("PRESCREEN_BYTES", 4096) # Bytes fetched for the sniff, power of two up to 512KB
+	PRESCREEN_MIN_SIZE = config["Telegram"].get("PRESCREEN_MIN_SIZE", 256) # Smaller files are skipped without a request
+	PRESCREEN_MAX_SIZE = config["Telegram"].get("PRESCREEN_MAX_SIZE", 0) # Bigger files are skipped, 0 to disable
+	PRESCREEN_ARCHIVES = config["Telegram"].get("PRESCREEN_ARCHIVES", False) # Also download the zip files listing a supported file
+	BACKFILL = config["Telegram"].get("BACKFILL", True) # First check of a big channel split in segments scanned at the same time
+	BACKFILL_SEGMENT_MESSAGES = config["Telegram"].get("BACKFILL_SEGMENT_MESSAGES", 20000) # Message ids per segment, smaller channels get the usual scan
+	BACKFILL_CONCURRENCY = config["Telegram"].get("BACKFILL_CONCURRENCY", 4) # Segments of the same channel scanned at the same time
+	BACKFILL_MAX_SECONDS = config["Telegram"].get("BACKFILL_MAX_SECONDS", 1800) # The backfill pauses after this and resumes at the next check, 0 to disable
 
 if(not (CHECK_HISTORY_OFFSET and SUPPORTED_FILETYPES and ROOT_PATH)):
 	sys.exit(-1)
 
+# What the scan picks up, the archives are only there if the pre-screen can look inside them
+CANDIDATE_FILETYPES = candidate_filetypes(SUPPORTED_FILETYPES, PRESCREEN and PRESCREEN_ARCHIVES)
+
 ##############################################################
 ### logging setup ############################################
 
@@ -38,34 +91,250 @@ log_level = LOG_LEVEL
 # NOTSET	0
 
 logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.CRITICAL, datefmt='%d/%m/%Y %H:%M:%S')
+
+# Our own modules that log on their own logger, telethon stays on CRITICAL
+LOGGED_MODULES = ('floodgate', 'analyzer', 'downloader', 'contentstore', 'checkpoint', 'entitycache', 'accounts', 'metrics', 'scheduler', 'service', 'prescreen', 'backfill')
+for module_name in LOGGED_MODULES:
+	logging.getLogger(module_name).setLevel(log_level)
+
 logging = logging.getLogger(__name__)
 logging.setLevel(log_level)
 
+if METRICS:
+	metrics.enable()
+
 ##############################################################
 
+# The daemon and the sweep can get the same message at the same time, the existance check + insert of an origin must not overlap
+origin_locks = {}
+
+def origin_lock(_id_origin):
+	return origin_locks.setdefault(_id_origin, asyncio.Lock())
+
 # Message and array of supported files
 def is_supported_filetype(message, supported_filetypes):
 	if hasattr(message.media, 'document'):
-		document = message.media.document
-		if isinstance(document.attributes[0], DocumentAttributeFilename):
-			file_name = document.attributes[0].file_name.lower()
+		file_name = document_file_name(message.media.document)
+		if file_name:
+			file_name = file_name.lower()
 			return any(file_name.endswith('.' + ext) for ext in supported_filetypes)
 	return False
 
 
-async def download_supported_files(pool, client, supported_filetypes, _id_origin, domain, last_checked):
+async def download_supported_files(pool, client, download_manager, supported_filetypes, _id_origin, domain, last_checked, floodgate=None, peer=None):
+
+	chat = peer or domain # The resolved peer saves a username lookup
 	
 	if(not last_checked):
 		last_checked = 0
 
-	new_checked = last_checked # Created to compare between old offset and possible new offset
+	checkpoint = Checkpoint(pool, _id_origin, domain, last_checked)
+
+	head_id = last_checked
+	if FILTERED_SCAN:
+		# Telegram sends back only the documents, so last_checked can't follow the messages we get.
+		# Everything up to the head of the channel at the start of the scan gets covered by it
+		latest = await client.get_messages(chat, limit=1)
+		if latest:
+			head_id = latest[0].id
+
+	new_checked, new_files, transfers, _ = await scan_range(pool, client, download_manager, supported_filetypes, _id_origin, domain, chat, checkpoint, last_checked,
+		end_id=head_id if FILTERED_SCAN else None, floodgate=floodgate)
+
+	if transfers:
+		logging.info('Scan of %s done, waiting for %s downloads', domain, len(transfers))
+		await asyncio.gather(*transfers)
 
-	async for message in client.iter_messages(domain, reverse=True , offset_id = last_checked): 
+	if last_checked == new_checked:
+		logging.info('No new messages for origin_id: %s - %s', _id_origin, domain)
+	elif await checkpoint.save() != new_checked:
+		logging.warning('Origin %s - %s checked up to %s, but some messages were not saved. The next scan restarts from %s', _id_origin, domain, new_checked, checkpoint.persisted)
+
+	# What the scheduler needs to know about this check. Message ids are sequential in a channel
+	return {'messages': new_checked - last_checked, 'files': new_files}
+
+
+# The messages after offset_id, up to max_id excluded (None for the head), go through the batched existance check and
+# the downloads, the progress is recorded on the checkpoint. end_id is where the checkpoint goes once the range is over.
+# Stops early at the deadline (time.monotonic()). Returns the last id covered, the new files, the downloads started and
+# whether the whole range was scanned
+async def scan_range(pool, client, download_manager, supported_filetypes, _id_origin, domain, chat, checkpoint, offset_id, max_id=None, end_id=None, floodgate=None, deadline=None):
 
-		new_checked = message.id
+	new_checked = offset_id # Created to compare between old offset and possible new offset
 
-		if is_supported_filetype(message, supported_filetypes):
+	# With more search passes the ids go back to the start at every pass, only the end of the scan is safe
+	intermediate_checkpoints = not (FILTERED_SCAN and FILTERED_SCAN_SEARCH and len(supported_filetypes) > 1)
+
+	candidates = [] # Supported messages waiting for the batched existance check
+	new_files = 0
+	last_flush = last_checkpoint = time.monotonic()
+	checkpoint_id = offset_id # The filtered scan gets only the documents, the progress is in message ids
+	transfers = [] # Downloads run in background while the scan goes on
+	complete = True
+
+	try:
+		async for message in scan_messages(client, chat, offset_id, supported_filetypes, max_id):
+
+			if floodgate:
+				await floodgate.wait() # Another origin got flood-waited, don't pile up requests on the same client
+
+			new_checked = message.id
+
+			if is_supported_filetype(message, supported_filetypes):
+				candidates.append(message)
+
+			checkpoint_due = intermediate_checkpoints and (new_checked - checkpoint_id >= CHECKPOINT_MESSAGES or time.monotonic() - last_checkpoint >= CHECKPOINT_SECONDS)
+
+			if checkpoint_due or (candidates and (len(candidates) >= DEDUPE_WINDOW or time.monotonic() - last_flush >= INSERT_FLUSH_SECONDS)):
+				batch_transfers, committed = [], True
+				if candidates:
+					async with origin_lock(_id_origin):
+						batch_transfers, committed, inserted = await process_candidates(pool, download_manager, _id_origin, domain, candidates)
+					new_files += inserted
+				# Every message up to this one went through the existance check and the inserts
+				checkpoint.add(new_checked, batch_transfers, committed)
+				transfers += batch_transfers
+				candidates = []
+				last_flush = time.monotonic()
+
+			if checkpoint_due:
+				await checkpoint.save()
+				checkpoint_id = new_checked
+				last_checkpoint = time.monotonic()
+
+			if deadline and time.monotonic() >= deadline:
+				complete = False
+				break
+	except Exception:
+		# A FloodWait aborts the scan: what the committed batches covered is kept, the retry goes on from there
+		if intermediate_checkpoints:
+			await checkpoint.save()
+		raise
+
+	batch_transfers, committed = [], True
+	if candidates:
+		async with origin_lock(_id_origin):
+			batch_transfers, committed, inserted = await process_candidates(pool, download_manager, _id_origin, domain, candidates)
+		new_files += inserted
+	transfers += batch_transfers
+
+	if complete and end_id:
+		new_checked = max(end_id, new_checked)
+	elif not complete and not intermediate_checkpoints:
+		new_checked = offset_id # Stopped in the middle of a search pass, nothing is safe
+	checkpoint.add(new_checked, batch_transfers, committed)
+
+	return new_checked, new_files, transfers, complete
+
+
+# First check of a big channel: its history is split in segments of BACKFILL_SEGMENT_MESSAGES ids scanned
+# BACKFILL_CONCURRENCY at a time, every segment with its own progress. After BACKFILL_MAX_SECONDS the backfill
+# pauses and the run goes on, the next check resumes the unfinished segments. last_checked is set at the end.
+async def backfill_supported_files(pool, client, download_manager, supported_filetypes, _id_origin, domain, floodgate=None, peer=None):
+
+	chat = peer or domain
+
+	segments = await selectBackfillSegments(pool, _id_origin)
+	if segments == None:
+		logging.error('Error while retrieving the backfill of origin_id: %s - %s', _id_origin, domain)
+		return {'messages': 0, 'files': 0}
+
+	if not segments:
+		latest = await client.get_messages(chat, limit=1)
+		head_id = latest[0].id if latest else 0
+		if head_id <= BACKFILL_SEGMENT_MESSAGES:
+			# A single segment, the usual scan does the same
+			return await download_supported_files(pool, client, download_manager, supported_filetypes, _id_origin, domain, 0, floodgate, peer)
+
+		segments = await insertBackfillSegments(pool, _id_origin, plan_segments(head_id, BACKFILL_SEGMENT_MESSAGES))
+		if not segments:
+			logging.error('Error while planning the backfill of origin_id: %s - %s', _id_origin, domain)
+			return {'messages': 0, 'files': 0}
+		logging.info('Backfill of origin_id: %s - %s, %s messages in %s segments', _id_origin, domain, head_id, len(segments))
+
+	head_id = max(segment['max_id'] for segment in segments)
+	pending = [segment for segment in segments if not segment_done(segment)]
+	logging.info('Backfill of origin_id: %s - %s, %s of %s segments left', _id_origin, domain, len(pending), len(segments))
+
+	deadline = time.monotonic() + BACKFILL_MAX_SECONDS if BACKFILL_MAX_SECONDS else None
+	semaphore = asyncio.Semaphore(max(1, BACKFILL_CONCURRENCY))
+
+	async def segment_worker(segment):
+		async with semaphore:
+			if deadline and time.monotonic() >= deadline:
+				return 0, 0, False
+
+			offset_id = segment['last_checked']
+			checkpoint = SegmentCheckpoint(pool, _id_origin, domain, segment)
+			try:
+				new_checked, new_files, transfers, _ = await scan_range(pool, client, download_manager, supported_filetypes, _id_origin, domain, chat, checkpoint,
+					offset_id, segment['max_id'] + 1, segment['max_id'], floodgate, deadline)
+				# The transfers belong to the shared DownloadManager: cancelling this segment must not abort them mid-file
+				await asyncio.shield(asyncio.gather(*transfers))
+			finally:
+				# Also when a FloodWait in another segment cancels this one, the retry redoes only what is left
+				await checkpoint.save()
+			return new_checked - offset_id, new_files, checkpoint.persisted >= segment['max_id']
+
+	tasks = [asyncio.create_task(segment_worker(segment)) for segment in pending]
+	try:
+		results = await asyncio.gather(*tasks)
+	except BaseException:
+		# A FloodWait stops every segment, the retry of the origin resumes them from their last checkpoint
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		raise
+
+	left = sum(not done for _, _, done in results)
+	if left:
+		logging.info('Backfill of origin_id: %s - %s paused with %s segments left, it goes on at the next check', _id_origin, domain, left)
+	elif await completeBackfill(pool, _id_origin, head_id) == head_id:
+		logging.info('Backfill of origin_id: %s - %s completed, last checked at %s', _id_origin, domain, head_id)
+	else:
+		logging.error('Error while completing the backfill of origin_id: %s - %s', _id_origin, domain)
 
+	return {'messages': sum(messages for messages, _, _ in results), 'files': sum(files for _, files, _ in results)}
+
+
+async def scan_messages(client, chat, last_checked, supported_filetypes, max_id=None):
+	max_id = max_id or 0 # Telethon's no limit
+	if not FILTERED_SCAN:
+		async for message in metrics.pages(client.iter_messages(chat, reverse=True , offset_id = last_checked, max_id = max_id), 'tgscraper_message_page_seconds'):
+			yield message
+
+	elif not FILTERED_SCAN_SEARCH:
+		async for message in metrics.pages(client.iter_messages(chat, reverse=True , offset_id = last_checked, max_id = max_id, filter=InputMessagesFilterDocument), 'tgscraper_message_page_seconds'):
+			yield message
+
+	else:
+		# Telegram takes a single search term, a file named like more extensions could come back twice
+		seen = set()
+		for ext in supported_filetypes:
+			async for message in metrics.pages(client.iter_messages(chat, reverse=True , offset_id = last_checked, max_id = max_id, filter=InputMessagesFilterDocument, search=ext), 'tgscraper_message_page_seconds'):
+				if message.id not in seen:
+					seen.add(message.id)
+					yield message
+
+
+async def process_candidates(pool, download_manager, _id_origin, domain, messages):
+
+	# One query for the whole window instead of one per message, the filtering happens here
+	checkSources = await selectSourceTelegramIdsByDomain(pool=pool, domain=domain, _ids_source_telegram=[message.id for message in messages])
+
+	if(checkSources == None):
+		logging.error('Error while checking source existance for domain %s', domain)
+		return [], False, 0
+
+	known_sources = Counter(row['_id_source_telegram'] for row in checkSources)
+	undownloaded_sources = {row['_id_source_telegram']: row['_id_source'] for row in checkSources if not row['is_downloaded']}
+
+	new_sources = [] # (message, source, source_telegram)
+	transfers = []
+
+	for message in messages:
+
+		if(known_sources[message.id] == 0):
 			source = {
 				'spam_score': 0,
 				'published_time': message.date,
@@ -80,64 +349,70 @@ async def download_supported_files(pool, client, supported_filetypes, _id_origin
 				'shares_count': message.forwards
 			}
 
-			checkSource = await selectSourceTegramByDomainAndMessage(pool=pool, domain=domain, _id_source_telegram=source_telegram['_id_source_telegram'])
-
-			if(checkSource != None):
-				if(len(checkSource) == 0 ):
-					_id_source = await insertSource(pool, source, source_telegram) # WARN Non testata domani piuttosto fanne una unica che crea in una singola transizione source e collegato source_telegram
-					if(_id_source):
-						logging.info('Valid source found with ID: %s', _id_source)
-						file_name = message.media.document.attributes[0].file_name
-						logging.info('Downloading %s', file_name)
-						file_path = os.path.join(ROOT_PATH, 'src/telegram/supported_files', file_name)
-						await client.download_media(message, file=file_path)
-						call_node_script(os.path.join(ROOT_PATH,"src/HalScripts/halAnalyzeDBs.js"), args=[("--target_file="+file_path),('--source_id='+str(_id_source))])
-				elif(len(checkSource) == 1 ):
-					logging.warning('Found source already scraped for domain %s with assigned source_telegram ID: %s', domain, str(source_telegram['_id_source_telegram']))
-				else:
-					logging.critical('Found multiple source lines assigned to the domain: %s. Error found with source_telegram ID: %s', domain, str(source_telegram['_id_source_telegram']))
-			else:
-				logging.error('Error while checking source existance for domain %s', domain)
-
-	if last_checked == new_checked:
-		logging.info('No new messages for origin_id: %s - %s', _id_origin, domain)
-	else:
-		if (await updateOriginLastChecked(pool, new_checked, _id_origin) == new_checked): # type: ignore
-			logging.info('Last checked for origin %s - %s updated at %s', _id_origin, domain, new_checked)
+			new_sources.append((message, source, source_telegram))
+		elif(known_sources[message.id] == 1 and message.id in undownloaded_sources):
+			logging.warning('Found source already scraped for domain %s with assigned source_telegram ID: %s but its file is missing, resuming the download', domain, str(message.id))
+			transfers.append(schedule_download(download_manager, message, undownloaded_sources[message.id]))
+		elif(known_sources[message.id] == 1):
+			logging.warning('Found source already scraped for domain %s with assigned source_telegram ID: %s', domain, str(message.id))
 		else:
-			logging.error('Error while updating last_checked for origin %s - %s', _id_origin, domain)
+			logging.critical('Found multiple source lines assigned to the domain: %s. Error found with source_telegram ID: %s', domain, str(message.id))
+
+	if new_sources and download_manager.prescreen:
+		# Reposts already in the content store are only linked, no need to sniff them
+		stored = await asyncio.gather(*(download_manager.content_store.lookup(message.media.document) for message, _, _ in new_sources))
+		to_check = [message for (message, _, _), content in zip(new_sources, stored) if not content]
+		# Skipped files never become sources, a later scan starts after them anyway
+		accepted = {message.id for message in await download_manager.prescreen.filter(to_check)} if to_check else set()
+		accepted.update(message.id for (message, _, _), content in zip(new_sources, stored) if content)
+		new_sources = [entry for entry in new_sources if entry[0].id in accepted]
+
+	if not new_sources:
+		return transfers, True, 0
+
+	if BULK_INSERT:
+		inserted = await insertSources(pool, [(source, source_telegram) for _, source, source_telegram in new_sources])
+		if(inserted == None):
+			logging.error('Error while inserting a batch of %s sources for domain %s', len(new_sources), domain)
+			return transfers, False, 0
+		logging.info('Inserted a batch of %s sources for domain %s', len(inserted), domain)
+	else:
+		inserted = {}
+		for _, source, source_telegram in new_sources:
+			_id_source = await insertSource(pool, source, source_telegram)
+			if(_id_source):
+				inserted[source_telegram['_id_source_telegram']] = _id_source
 
+	for message, _, _ in new_sources:
+		if message.id in inserted:
+			logging.info('Valid source found with ID: %s', inserted[message.id])
+			transfers.append(schedule_download(download_manager, message, inserted[message.id]))
+
+	# Downloads started, all the new sources saved, how many of them
+	return transfers, len(inserted) == len(new_sources), len(inserted)
+
+
+def schedule_download(download_manager, message, _id_source):
+	file_name = document_file_name(message.media.document)
+	logging.info('Downloading %s', file_name)
+	return download_manager.schedule(message, file_name, _id_source) # Once downloaded the file goes to the analysis queue
 
-	
-def call_node_script(script_path, args=None):
-	logging.debug('Calling node subprocess %s', script_path)
-	command = ["node", script_path]
-	
-	if args:
-		command.extend(args)
-	
-	try:
-		result = subprocess.run(command, capture_output=True, text=True)
-		if result.returncode == 0:
-			logging.debug('Subprocess executed successfully')
-			logging.info(result.stdout)
-		else:
-			logging.error('Subprocess execution failed.\n%s',result.stderr)
-	except FileNotFoundError:
-		print("Node.js interpreter not found. Please make sure Node.js is installed.")
 
 async def main():
 	logging.info('Welcome to the still unnamed telgram scraper! Initializiating the components:')
 
+	argv = initialize_options()
+
 	os.makedirs('supported_files', exist_ok=True)
 
 	##############################################################
 	### Client initialization ####################################
 
-	client = await initialize_client()
-	if(client):
-		me = await client.get_me() 
-		logging.info('Client online with user %s', me.username) # type: ignore
+	clients = await initialize_clients(ACCOUNTS)
+	if(clients):
+		for phone_number, client in clients:
+			me = await client.get_me() 
+			logging.info('Client online with user %s', me.username) # type: ignore
 	else:
 		logging.error('Connection to the client failed')
 		return -1
@@ -154,61 +429,232 @@ async def main():
 	
 	##############################################################
 
-	logging.info('Looking for supported files of type: %s', SUPPORTED_FILETYPES)
+	analysis_queue, account_pool, entity_cache, scheduler = await initialize_components(pool, clients)
+
+	##############################################################
+
+	logging.info('Looking for supported files of type: %s', CANDIDATE_FILETYPES)
 
-	telegram_origins = await selectOrigins(pool=pool) # type: ignore
+	if argv.Daemon:
+		await run_daemon(pool, account_pool, entity_cache, scheduler)
+	else:
+		await run_once(pool, account_pool, entity_cache, scheduler)
 
-	if(telegram_origins):
-		logging.info('Sourced %s origins from the database', len(telegram_origins))
-		for origin in telegram_origins:
-			_id_origin = origin['_id_origin']  # Non riesco a capire come farmi una strutturina al volo, non molto pratico di python ^^' Boh mettermi a far classi per questo mi sembra un po' eeh
-			last_checked_id = origin['last_checked']
-			updated_time = origin['updated_time']
-			is_dead_score = origin['is_dead_score']
-
-			if re.match(r"^-[0-9]{13}$", origin['domain']):
-				domain = int(origin['domain'])
-			else:
-				domain = origin['domain']
-
-			additional_infos = await get_channel_info(client=client, channel_username=domain)
-			if(additional_infos): # Channel still alive
-				### Check freshness history
-
-				if (datetime.utcnow().replace(tzinfo=pytz.UTC) - updated_time) > timedelta(milliseconds=CHECK_HISTORY_OFFSET):
-					logging.info('The source %s looks kinda dusty. Time to refresh its data', _id_origin)
-
-					if((await updateOriginDeadScore(pool=pool, is_dead_score=0, _id_origin=_id_origin)) == 0): # type: ignore
-						logging.info('Dead score resetted for origin_id: %s - %s', _id_origin, domain)
-					
-					parsed_additional_infos = await parse_channel_info(additional_infos)
-
-					if(parsed_additional_infos):
-						origin_history = {
-							'additional_infos': str( additional_infos),
-							'_id_origin': _id_origin
-						}
-						_id_origin_history = await insertOriginHistory(pool=pool, origin_history=origin_history) # type: ignore
-						if(_id_origin_history):
-							logging.info('A new origin history associated to origin_id: %s - %s has been added to the database. Assigned history ID: %s', _id_origin, domain, _id_origin_history)
-						else:
-							logging.error('Error while inserting a new origin_history associated to the origin_id: %s - %s', _id_origin, domain)
-			
-				### Gathering valid filetype sources
+	await wait_transfers(account_pool, analysis_queue)
 
-				await download_supported_files(pool, client, SUPPORTED_FILETYPES, _id_origin, domain, last_checked_id)
+	metrics.write_textfile(METRICS_TEXTFILE)
+	metrics.log_summary()
 
-				logging.info('Search terminated for the origin_id: %s - %s, files saved in the "supported_files" folder ^w^', _id_origin, domain)
 
-			else: # Not responding, increase deadness
-				logging.error('The origin_id: %s - %s does not respond to telegram API, check the name inserted', _id_origin, domain)
+# Everything the scraping needs on top of the clients and the pool, shared with the service
+async def initialize_components(pool, clients):
+	analysis_queue = AnalysisQueue(pool, os.path.join(ROOT_PATH,"src/HalScripts/halAnalyzeDBs.js"), ANALYSIS_WORKERS, ANALYSIS_MAX_ATTEMPTS, ANALYSIS_RETRY_SECONDS)
+	await analysis_queue.resume()
 
-				if(await updateOriginDeadScore(pool=pool, is_dead_score=is_dead_score+1, _id_origin=_id_origin) == is_dead_score+1): # type: ignore
-					logging.info('Dead score incremented for origin_id: %s - %s', _id_origin, domain)
-	
+	content_store = ContentStore(pool, os.path.join(ROOT_PATH, 'src/telegram/supported_files'))
+	entity_cache = EntityCache(pool, ENTITY_CACHE_TTL)
+
+	# Every account has its own flood budget and transfers, the analysis and the stored files are shared
+	accounts = []
+	bandwidth = Bandwidth(MAX_DOWNLOAD_BYTES_PER_SECOND) # The cap is global, not per account
+	for phone_number, client in clients:
+		floodgate = FloodGate()
+		prescreen = PreScreen(client, SUPPORTED_FILETYPES, PRESCREEN_BYTES, PRESCREEN_MIN_SIZE, PRESCREEN_MAX_SIZE, PRESCREEN_ARCHIVES, MAX_CONCURRENT_DOWNLOADS, floodgate) if PRESCREEN else None
+		download_manager = DownloadManager(client, analysis_queue, content_store, MAX_CONCURRENT_DOWNLOADS, DOWNLOAD_CHUNK_SIZE, bandwidth, DOWNLOAD_RETRIES, floodgate, prescreen)
+		accounts.append(Account(phone_number, client, floodgate, download_manager))
+	account_pool = AccountPool(accounts)
+	logging.info('Scraping with %s telegram accounts', len(accounts))
+
+	scheduler = Scheduler(pool, SCHEDULE_MIN_INTERVAL, SCHEDULE_MAX_INTERVAL, SCHEDULE_ACTIVITY_DECAY, SCHEDULER)
+
+	return analysis_queue, account_pool, entity_cache, scheduler
+
+
+async def wait_transfers(account_pool, analysis_queue):
+	for account in account_pool.accounts:
+		if account.download_manager.pending():
+			logging.info('Scraping done, waiting for %s downloads of account %s', account.download_manager.pending(), account.name)
+		await account.download_manager.join()
+
+	if analysis_queue.pending():
+		logging.info('Scraping done, waiting for %s files still in analysis', analysis_queue.pending())
+	await analysis_queue.join()
+
+
+async def run_once(pool, account_pool, entity_cache, scheduler):
+	telegram_origins = await scheduler.due_origins()
+
+	if(telegram_origins):
+		logging.info('Sourced %s origins due for a check from the database', len(telegram_origins))
+		await scrape_origins(pool, account_pool, entity_cache, scheduler, telegram_origins)
+	elif(telegram_origins != None and scheduler.enabled):
+		logging.info('No origin is due for a check yet')
 	else:
 		logging.error('Error while retrieving the origins from the database ;w; Check the database or ensure to add telegram origins via tginsert.py')
 
 
+async def run_daemon(pool, account_pool, entity_cache, scheduler):
+	# Telegram pushes the new messages only for the channels the account has joined, the others are covered by the sweep
+	tracked_chats = {} # peer id -> origin
+	resolved_domains = {} # domain -> peer id
+
+	# Every account gets the updates of its own joined channels, the message is downloaded by the same account
+	def new_message_handler(account):
+		async def on_new_message(event):
+			origin = tracked_chats.get(event.chat_id)
+			if not origin or not is_supported_filetype(event.message, CANDIDATE_FILETYPES):
+				return
+
+			domain = parse_domain(origin['domain'])
+			logging.info('New supported file posted in origin_id: %s - %s, message ID: %s (account %s)', origin['_id_origin'], domain, event.message.id, account.name)
+			try:
+				async with origin_lock(origin['_id_origin']):
+					transfers, _, _ = await process_candidates(pool, account.download_manager, origin['_id_origin'], domain, [event.message])
+				await asyncio.gather(*transfers)
+			except Exception as e:
+				logging.exception('Unexpected error while ingesting message %s of origin_id: %s - %s: %s', event.message.id, origin['_id_origin'], domain, e)
+		return on_new_message
+
+	for account in account_pool.accounts:
+		account.client.add_event_handler(new_message_handler(account), events.NewMessage())
+	logging.info('Daemon mode on, catch-up sweep every %s seconds', DAEMON_SWEEP_SECONDS)
+
+	while True:
+		telegram_origins = await selectOrigins(pool=pool) # type: ignore
+
+		if(telegram_origins):
+			# Follow the origins added since the last sweep before starting the long scan
+			for origin in telegram_origins:
+				if origin['domain'] not in resolved_domains:
+					account = account_pool.for_origin(origin['_id_origin'])
+					if not account:
+						break
+					try:
+						resolved_domains[origin['domain']] = await account.client.get_peer_id(parse_domain(origin['domain']))
+					except Exception as e:
+						logging.warning('Unable to subscribe to origin_id: %s - %s: %s', origin['_id_origin'], origin['domain'], e)
+						continue
+				tracked_chats[resolved_domains[origin['domain']]] = origin
+
+			logging.info('Listening for new messages of %s origins', len(tracked_chats))
+
+			# Every origin is followed, only the due ones get the catch-up scan
+			due_origins = await scheduler.due_origins()
+			if due_origins:
+				await scrape_origins(pool, account_pool, entity_cache, scheduler, due_origins)
+		else:
+			logging.error('Error while retrieving the origins from the database ;w; Check the database or ensure to add telegram origins via tginsert.py')
+
+		metrics.write_textfile(METRICS_TEXTFILE) # The daemon never reaches the end of main
+		await asyncio.sleep(DAEMON_SWEEP_SECONDS)
+
+
+async def scrape_origins(pool, account_pool, entity_cache, scheduler, telegram_origins):
+	# The concurrency grows with the accounts, every account gets its own share of origins
+	max_concurrent_origins = max(1, MAX_CONCURRENT_ORIGINS) * max(1, len(account_pool.available()))
+	semaphore = asyncio.Semaphore(max_concurrent_origins)
+
+	logging.info('Scraping with up to %s origins at the same time', max_concurrent_origins)
+
+	async def worker(origin):
+		async with semaphore:
+			for attempt in range(FLOOD_WAIT_RETRIES + 1):
+				account = account_pool.for_origin(origin['_id_origin'])
+				if not account:
+					logging.error('No telegram account left to scrape origin_id: %s - %s', origin['_id_origin'], origin['domain'])
+					return False
+
+				await account.floodgate.wait()
+				try:
+					stats = await scrape_origin(pool, account, entity_cache, origin)
+					account.origins += 1
+					await scheduler.record(origin, stats, 0 if stats else origin['is_dead_score'] + 1)
+					return True
+				except FloodWaitError as e:
+					# Pause this account and retry the origin on the next free one, the dedupe check skips what was already saved
+					logging.warning('FloodWait on account %s while scraping origin_id: %s - %s (attempt %s/%s)', account.name, origin['_id_origin'], origin['domain'], attempt + 1, FLOOD_WAIT_RETRIES + 1)
+					account.flood_wait(e.seconds)
+					# The retry goes on from the checkpoints of this attempt, not from the row read at the start of the run
+					last_checked = await selectOriginLastChecked(pool, origin['_id_origin'])
+					if last_checked != None:
+						origin = {**origin, 'last_checked': last_checked}
+				except BAN_ERRORS as e:
+					account_pool.ban(account, e)
+				except Exception as e:
+					# One broken origin must not take down the whole run
+					account.failures += 1
+					logging.exception('Unexpected error while scraping origin_id: %s - %s: %s', origin['_id_origin'], origin['domain'], e)
+					return False
+			logging.error('Giving up on origin_id: %s - %s after %s attempts', origin['_id_origin'], origin['domain'], FLOOD_WAIT_RETRIES + 1)
+			return False
+
+	results = await asyncio.gather(*(worker(origin) for origin in telegram_origins))
+
+	total_wait_seconds = sum(account.floodgate.total_wait_seconds for account in account_pool.accounts)
+	logging.info('Run completed: %s origins scraped, %s failed. Total FloodWait: %s seconds', results.count(True), results.count(False), total_wait_seconds)
+	account_pool.log_stats()
+	return results
+
+
+async def scrape_origin(pool, account, entity_cache, origin):
+	client = account.client
+	_id_origin = origin['_id_origin']  # Non riesco a capire come farmi una strutturina al volo, non molto pratico di python ^^' Boh mettermi a far classi per questo mi sembra un po' eeh
+	last_checked_id = origin['last_checked']
+	updated_time = origin['updated_time']
+	is_dead_score = origin['is_dead_score']
+
+	domain = parse_domain(origin['domain'])
+
+	history_due = (datetime.utcnow().replace(tzinfo=pytz.UTC) - updated_time) > timedelta(milliseconds=CHECK_HISTORY_OFFSET)
+
+	# The full channel request is needed only to refresh the history, otherwise the cached entity is enough
+	peer, additional_infos = await entity_cache.resolve(client, account.name, _id_origin, domain, full=history_due)
+	if(peer): # Channel still alive
+		### Check freshness history
+
+		if history_due and additional_infos:
+			logging.info('The source %s looks kinda dusty. Time to refresh its data', _id_origin)
+
+			if((await updateOriginDeadScore(pool=pool, is_dead_score=0, _id_origin=_id_origin)) == 0): # type: ignore
+				logging.info('Dead score resetted for origin_id: %s - %s', _id_origin, domain)
+			
+			parsed_additional_infos = await parse_channel_info(additional_infos)
+
+			if(parsed_additional_infos and not history_changed(origin['parsed_infos'], parsed_additional_infos, HISTORY_TRACKED_FIELDS)):
+				# Same channel as the last snapshot, no need for a new row
+				if(await updateOriginHistoryTime(pool=pool, _id_origin_history=origin['_id_origin_history'])):
+					logging.info('Nothing changed for origin_id: %s - %s, origin history ID: %s marked as fresh', _id_origin, domain, origin['_id_origin_history'])
+				else:
+					logging.error('Error while refreshing the origin_history associated to the origin_id: %s - %s', _id_origin, domain)
+
+			elif(parsed_additional_infos):
+				origin_history = {
+					'parsed_infos': parsed_additional_infos,
+					'_id_origin': _id_origin
+				}
+				_id_origin_history = await insertOriginHistory(pool=pool, origin_history=origin_history) # type: ignore
+				if(_id_origin_history):
+					logging.info('A new origin history associated to origin_id: %s - %s has been added to the database. Assigned history ID: %s', _id_origin, domain, _id_origin_history)
+				else:
+					logging.error('Error while inserting a new origin_history associated to the origin_id: %s - %s', _id_origin, domain)
+	
+		### Gathering valid filetype sources
+
+		if BACKFILL and not last_checked_id:
+			stats = await backfill_supported_files(pool, client, account.download_manager, CANDIDATE_FILETYPES, _id_origin, domain, account.floodgate, peer)
+		else:
+			stats = await download_supported_files(pool, client, account.download_manager, CANDIDATE_FILETYPES, _id_origin, domain, last_checked_id, account.floodgate, peer)
+
+		logging.info('Search terminated for the origin_id: %s - %s, files saved in the "supported_files" folder ^w^', _id_origin, domain)
+		return stats
+
+	else: # Not responding, increase deadness
+		logging.error('The origin_id: %s - %s does not respond to telegram API, check the name inserted', _id_origin, domain)
+
+		if(await updateOriginDeadScore(pool=pool, is_dead_score=is_dead_score+1, _id_origin=_id_origin) == is_dead_score+1): # type: ignore
+			logging.info('Dead score incremented for origin_id: %s - %s', _id_origin, domain)
+		return None
+
+
 if __name__ == "__main__":
 	asyncio.get_event_loop().run_until_complete(main())
\ No newline at end of file
@@ -11,12 +11,15 @@ import { input } from '@inquirer/prompts';
 import checkbox from '@inquirer/checkbox';
 import { ChildProcessWithoutNullStreams, spawn } from 'child_process'
 import path from "path";
+import fs from "fs";
+import os from "os";
 
 import { load_configuration } from "./src/modules/conf_loader.js";
 import { exploreHTTP } from "./src/M-O_Scraper/explorerHTTP.js";
 import { cleandb } from './devScripts/cleandb.js';
 import { scraperHTTP } from './src/M-O_Scraper/scraperHTTP.js';
 import { close_pool, search, search_source_thread } from './src/TA-NK_database/LFT-R.js';
+import { TelegramService } from './src/modules/tgservice.js';
 
 // http://127.0.0.1/siti_baddies/new_nulled_5pages/www.nulled.to/forum/184-dumps-databases/index5ac3.html
 // http://breachedu76kdyavc6szj6ppbplfqoz3pgrk3zw57my4vybgblpfeayd.onion/Forum-Databases
@@ -33,6 +36,9 @@ if(!config){
     process.exit(-1)
 }
 
+// Telegram clients and pool kept warm between the commands, started at the first telegram command
+const tgservice = new TelegramService(config.ROOT_PATH)
+
 
 ////////////////////////////////////////////////////////////////////
 
@@ -84,7 +90,7 @@ do{
             break;
             case 1: // Telegram
             keepgoing = await tginsert( 
-                await input({ message: 'Enter the telegram tag to setup: '})
+                await input({ message: 'Enter the telegram tag to setup (more tags separated by spaces, or @file with one per line): '})
                 )
                 break;
                 default:
@@ -125,6 +131,7 @@ do{
             break;
             case 0:
             close_pool()
+            await tgservice.stop()
             console.log("Byeeeeeeee!")
             break;
             default:
@@ -172,7 +179,38 @@ do{
         //@ts-ignore controllato già a inizio file
         process.chdir(path.join(config.ROOT_PATH, "/src/telegram/")) 
         
-        const py = spawn("python", ["tginsert.py", "--AddOrigin" , telgram_tag])
+        // More tags go through the bulk import: one login, one pool and one existance query for all of them
+        const tags = telgram_tag.split(/[\s,]+/).filter(tag => tag)
+
+        // The warm service first, the spawn below is still there for the first login
+        if (await tgservice_available()) {
+            try {
+                const origins = telgram_tag.startsWith('@') ?
+                //@ts-ignore controllato già a inizio file
+                    fs.readFileSync(path.resolve(config.ROOT_PATH, telgram_tag.slice(1)), 'utf8').split('\n').map(line => line.trim()).filter(line => line && !line.startsWith('#')) : tags
+                const report = await tgservice.request('add_origin', { origins: origins })
+                report.forEach((result : { origin : string, status : string, _id_origin : number | null }) => {
+                    const line = `${result.origin}: ${result.status}` + (result._id_origin ? ` (ID: ${result._id_origin})` : '')
+                    console.log(result.status == 'added' ? style.success(line) : result.status == 'exists' || result.status == 'duplicate' ? style.info(line) : style.error(line))
+                })
+            } catch (err) {
+                console.log(style.error(`Error while adding the origins: ${(err as Error).message}`))
+            }
+            return await confirm({ message: "Do you want to return to the main menu? ^w^", default: true })
+        }
+
+        let args = ["tginsert.py", "--AddOrigin", telgram_tag]
+        let list_path: string | undefined
+        if (telgram_tag.startsWith('@')) {
+            //@ts-ignore controllato già a inizio file
+            args = ["tginsert.py", "--ImportOrigins", path.resolve(config.ROOT_PATH, telgram_tag.slice(1))]
+        } else if (tags.length > 1) {
+            list_path = path.join(os.tmpdir(), `walle_origins_${process.pid}.txt`) // Not stdin, the login can ask for the code there
+            fs.writeFileSync(list_path, tags.join('\n'))
+            args = ["tginsert.py", "--ImportOrigins", list_path]
+        }
+
+        const py = spawn("python", args)
         py.stdout.on('data', async (data) => {
             const line = data.toString()
             console.log('\n' + line)
@@ -184,7 +222,11 @@ do{
             console.log('Error: ' + data);
         });
         
-        await promiseFromChildProcess(py);
+        try {
+            tgservice_fallback_done(await promiseFromChildProcess(py));
+        } finally {
+            if (list_path) fs.rmSync(list_path, { force: true })
+        }
         
         return await confirm({ message: "Do you want to return to the main menu? ^w^", default: true })
     }
@@ -193,6 +235,15 @@ do{
         
         //@ts-ignore controllato già a inizio file
         process.chdir(path.join(config.ROOT_PATH, "/src/telegram/")) 
+
+        if (await tgservice_available()) {
+            try {
+                await tgservice.request('scrape_now', { wait: true }) // The summary comes with the scrape_done notification
+            } catch (err) {
+                console.log(style.error(`Error while scraping: ${(err as Error).message}`))
+            }
+            return await confirm({ message: "Do you want to return to the main menu? ^w^", default: true })
+        }
         
         const py = spawn("python", ["tgscraper.py"])
         py.stdout.on('data', (data) => {
@@ -202,7 +253,7 @@ do{
             console.log('Error: ' + data);
         });
         
-        await promiseFromChildProcess(py);
+        tgservice_fallback_done(await promiseFromChildProcess(py));
         
         return await confirm({ message: "Do you want to return to the main menu? ^w^", default: true })
     }
@@ -258,6 +309,23 @@ do{
         }
     }
     
+    async function tgservice_available() : Promise<boolean> {
+        try {
+            await tgservice.start()
+            return true
+        } catch (err) {
+            console.log(style.info(`Telegram service not available (${(err as Error).message}), running the script instead`))
+            return false
+        }
+    }
+    
+    // A script run that went well has the session logged in, the service can be tried again at the next command
+    function tgservice_fallback_done(exit_code : unknown) {
+        if (exit_code === 0) {
+            tgservice.reset()
+        }
+    }
+    
     function promiseFromChildProcess(child : ChildProcessWithoutNullStreams ) {
         return new Promise(function (resolve, reject) {
             child.addListener("error", reject);